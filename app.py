@@ -1,9 +1,20 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for
+from flask import Flask, request, jsonify, render_template, redirect, url_for, send_file, Response
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 import psycopg2
+from psycopg2 import pool
 from psycopg2.extras import RealDictCursor
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
+import re
+import json
+import queue
+import hashlib
+import tempfile
+import threading
+import time
+from events import ChangeFeed, CHANGES_CHANNEL
+from categories import CategoryIndex
+from models import expense_fingerprint
 
 app = Flask(__name__)
 
@@ -22,6 +33,56 @@ DB_CONFIG = {
     "port": "5432"
 }
 
+# Фоновые задачи: каталог с результатами и допустимые типы задач
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'job_results'))
+JOB_KINDS = ('export', 'report')
+
+# Вложения: каталог хранилища, допустимые типы, лимит размера и размер блока чтения
+ATTACHMENTS_DIR = os.environ.get('ATTACHMENTS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'attachments'))
+ATTACHMENT_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'application/pdf')
+MAX_ATTACHMENT_SIZE = int(os.environ.get('MAX_ATTACHMENT_SIZE', str(10 * 1024 * 1024)))
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+
+# Пространство advisory-блокировок, которые упорядочивают номера изменений пользователя для /sync
+SYNC_LOCK_SPACE = 1
+
+# Дубликаты: окно поиска и политика ('flag' - пометить, 'reject' - отклонить)
+DUPLICATE_WINDOW_MINUTES = int(os.environ.get('DUPLICATE_WINDOW_MINUTES', '60'))
+DUPLICATE_POLICY = os.environ.get('DUPLICATE_POLICY', 'flag')
+DUPLICATE_POLICIES = ('flag', 'reject')
+if DUPLICATE_POLICY not in DUPLICATE_POLICIES:
+    raise ValueError(f"DUPLICATE_POLICY={DUPLICATE_POLICY!r}, допустимо: {', '.join(DUPLICATE_POLICIES)}")
+
+# Пул соединений создаётся при прогреве (warm_up); до этого соединения открываются напрямую.
+# psycopg2 закрывает соединения, возвращённые сверх minconn, поэтому minconn равен
+# числу потоков воркера: иначе при нагрузке каждый запрос заново подключается к БД
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', os.environ.get('WEB_THREADS', '4')))
+DB_POOL_MAX = max(DB_POOL_MIN, int(os.environ.get('DB_POOL_MAX', '10')))
+# Сколько секунд запрос ждёт свободное соединение, когда пул исчерпан
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '30'))
+db_pool = None
+
+# Приложение готово принимать трафик только после прогрева
+app.config['READY'] = False
+# Пауза между повторными попытками прогрева, если при старте воркера БД недоступна
+WARM_UP_RETRY_INTERVAL = float(os.environ.get('WARM_UP_RETRY_INTERVAL', '5'))
+
+# Поток изменений для SSE: буфер на подписчика и интервал keepalive
+SSE_BUFFER_SIZE = int(os.environ.get('SSE_BUFFER_SIZE', '100'))
+SSE_HEARTBEAT = 15
+# Задержка переподключения (мс), которую поток передаёт клиенту при остановке воркера
+SSE_RECONNECT_DELAY = 500
+# Открытый SSE-поток держит поток воркера gthread, пока вкладка открыта. Под SSE отдаём
+# не больше половины потоков, остальные всегда свободны для обычных запросов;
+# сверх лимита /events отвечает 503, и страница переходит на опрос /sync
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', str(max(1, int(os.environ.get('WEB_THREADS', '4')) // 2))))
+change_feed = ChangeFeed(DB_CONFIG, buffer_size=SSE_BUFFER_SIZE, max_subscribers=SSE_MAX_STREAMS)
+
+# Подсказки категорий: число пользователей, чьи индексы держим в памяти, и срок жизни
+# индекса пользователя в секундах (страховка, если уведомление об изменении потеряно)
+CATEGORY_INDEX_USERS = int(os.environ.get('CATEGORY_INDEX_USERS', '1000'))
+CATEGORY_INDEX_TTL = float(os.environ.get('CATEGORY_INDEX_TTL', '300'))
+
 class User(UserMixin):
     def __init__(self, id, username):
         self.id = id
@@ -30,30 +91,267 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    conn = psycopg2.connect(**DB_CONFIG)
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-    user_data = cur.fetchone()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
+        user_data = cur.fetchone()
+        cur.close()
     
     if user_data:
         return User(user_data['id'], user_data['username'])
     return None
 
+class BlockingConnectionPool(pool.ThreadedConnectionPool):
+    # Пул, в котором getconn ждёт освободившееся соединение, а не бросает
+    # PoolError: у dev-сервера число потоков не ограничено
+    def __init__(self, minconn, maxconn, timeout, *args, **kwargs):
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._timeout = timeout
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise pool.PoolError("timed out waiting for a database connection")
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+
+class PooledConnection:
+    # Обёртка над соединением: close() возвращает соединение в пул (без пула - закрывает).
+    # В блоке with соединение возвращается и при исключении; незавершённую
+    # транзакцию пул откатывает сам
+    def __init__(self, conn_pool, conn):
+        self._pool = conn_pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._pool is None:
+            conn.close()
+        else:
+            self._pool.putconn(conn)
+
+
 def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
+    # Одно соединение на поток за раз: вложенный вызов при исчерпанном пуле ждал бы сам себя
+    if db_pool is None:
+        return PooledConnection(None, psycopg2.connect(**DB_CONFIG))
+    return PooledConnection(db_pool, db_pool.getconn())
 
-def log_audit(user_id, action_type, record_id=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
+
+def init_db_pool():
+    global db_pool
+    if db_pool is None:
+        db_pool = BlockingConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, **DB_CONFIG)
+    return db_pool
+
+
+# Частые запросы, которые выполняются при прогреве на каждом соединении пула
+WARM_UP_QUERIES = [
+    ("SELECT * FROM users WHERE id = %s", (-1,)),
+    ("SELECT * FROM expenses WHERE user_id = %s ORDER BY created_at DESC", (-1,)),
+    ("SELECT user_id, amount, category, description FROM expenses WHERE id = %s", (-1,)),
+    ("SELECT * FROM audit_log WHERE user_id = %s ORDER BY action_time DESC", (-1,)),
+    ("EXPLAIN INSERT INTO audit_log (user_id, action_type, record_id) VALUES (%s, %s, %s)", (-1, 'warm_up', None)),
+]
+
+
+def warm_up():
+    # Прогрев при запуске: проверка схемы без DDL, открытие пула,
+    # компиляция шаблонов и первые выполнения частых запросов
+    from models import check_schema
+
+    conn_pool = init_db_pool()
+    conns = [conn_pool.getconn() for _ in range(DB_POOL_MIN)]
+    try:
+        check_schema(conns[0])
+        for conn in conns:
+            cur = conn.cursor()
+            for query, params in WARM_UP_QUERIES:
+                cur.execute(query, params)
+                cur.fetchall()
+            cur.close()
+            conn.rollback()
+    finally:
+        for conn in conns:
+            conn_pool.putconn(conn)
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    app.config['READY'] = True
+
+
+def init_worker(threads=None):
+    # Вызывается в каждом рабочем процессе после fork: пул и прочие
+    # ресурсы родителя не наследуются, а создаются заново.
+    # threads - число потоков воркера, под него подстраивается размер пула
+    global db_pool, DB_POOL_MIN, DB_POOL_MAX
+    if threads:
+        DB_POOL_MIN = max(DB_POOL_MIN, threads)
+        DB_POOL_MAX = max(DB_POOL_MAX, DB_POOL_MIN)
+        if 'SSE_MAX_STREAMS' not in os.environ:
+            change_feed.max_subscribers = max(1, threads // 2)
+    db_pool = None
+    change_feed.reset()
+    category_index.reset()
+    app.config['READY'] = False
+    
+    # Ошибка прогрева не должна ронять воркер: gunicorn остановил бы весь мастер.
+    # Воркер остаётся неготовым (/readyz отвечает 503) и повторяет прогрев в фоне
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"Warm-up failed, retrying in background: {e}")
+        threading.Thread(target=retry_warm_up, daemon=True).start()
+
+
+def retry_warm_up():
+    while not app.config['READY']:
+        time.sleep(WARM_UP_RETRY_INTERVAL)
+        try:
+            warm_up()
+        except Exception as e:
+            print(f"Warm-up retry failed: {e}")
+
+
+def close_worker():
+    # Закрытие ресурсов процесса после завершения обработки запросов
+    global db_pool
+    app.config['READY'] = False
+    if db_pool is not None:
+        db_pool.closeall()
+        db_pool = None
+
+def notify_change(cur, user_id, action, expense_id):
+    # Уведомление доставляется слушателям при commit той же транзакции
+    cur.execute("SELECT pg_notify(%s, %s)", (CHANGES_CHANNEL, json.dumps({
+        "user_id": user_id,
+        "action": action,
+        "expense_id": expense_id,
+        "origin": change_feed.origin
+    })))
+
+def lock_user_changes(cur, user_id):
+    # Номер изменения выдаётся при выполнении запроса, а виден только после commit.
+    # Пишущая транзакция берёт блокировку до nextval и держит её до commit, а /sync -
+    # разделяемую: токен не обгонит изменение, которое ещё не закоммичено
+    cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (SYNC_LOCK_SPACE, user_id))
+
+def remove_expense(cur, user_id, expense_id):
+    # Удаление с надгробием, чтобы /sync сообщил клиентам об удалении.
+    # Возвращает категорию удалённой записи для индекса подсказок и хеши
+    # вложений без ссылок, которые после commit удаляет remove_orphaned_attachments
+    lock_user_changes(cur, user_id)
+    orphaned = release_attachments(cur, expense_id)
+    cur.execute("DELETE FROM expenses WHERE id = %s RETURNING category", (expense_id,))
+    category = cur.fetchone()['category']
     cur.execute("""
-        INSERT INTO audit_log (user_id, action_type, record_id)
-        VALUES (%s, %s, %s)
-    """, (user_id, action_type, record_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+        INSERT INTO expense_tombstones (expense_id, user_id, change_seq)
+        VALUES (%s, %s, nextval('expense_change_seq'))
+    """, (expense_id, user_id))
+    notify_change(cur, user_id, "delete", expense_id)
+    return category, orphaned
+
+def attachment_path(sha256):
+    return os.path.join(ATTACHMENTS_DIR, sha256[:2], sha256)
+
+def release_attachments(cur, expense_id):
+    # Отвязываем вложения удаляемого расхода и уменьшаем счётчики ссылок
+    cur.execute("""
+        WITH unlinked AS (
+            DELETE FROM expense_attachments WHERE expense_id = %s RETURNING sha256
+        )
+        UPDATE attachments SET ref_count = attachments.ref_count - 1
+        FROM unlinked
+        WHERE attachments.sha256 = unlinked.sha256
+        RETURNING attachments.sha256, attachments.ref_count
+    """, (expense_id,))
+    return [row['sha256'] for row in cur.fetchall() if row['ref_count'] <= 0]
+
+def remove_orphaned_attachments(hashes=None):
+    # Удаляет вложения без ссылок вместе с файлами. Вызывается после commit удаления
+    # расхода (при откате строка вернулась бы без файла) и периодически воркером -
+    # для остатков после сбоя между commit и очисткой (hashes=None).
+    # DELETE блокирует строки: параллельная загрузка того же содержимого дождётся
+    # commit и запишет файл заново, а загрузка, успевшая раньше, поднимет ref_count
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        if hashes is None:
+            cur.execute("DELETE FROM attachments WHERE ref_count <= 0 RETURNING sha256")
+        else:
+            cur.execute("""
+                DELETE FROM attachments
+                WHERE sha256 = ANY(%s) AND ref_count <= 0
+                RETURNING sha256
+            """, (hashes,))
+        for (sha256,) in cur.fetchall():
+            path = attachment_path(sha256)
+            if os.path.exists(path):
+                os.remove(path)
+        conn.commit()
+        cur.close()
+
+def load_user_categories(user_id):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT category, COUNT(*) FROM expenses
+            WHERE user_id = %s
+            GROUP BY category
+        """, (user_id,))
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+category_index = CategoryIndex(load_user_categories, max_users=CATEGORY_INDEX_USERS, ttl=CATEGORY_INDEX_TTL)
+# Изменения из других процессов (воркеров gunicorn) сбрасывают индекс пользователя
+change_feed.add_callback(category_index.invalidate)
+
+def log_audit(user_id, action_type, record_id=None):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO audit_log (user_id, action_type, record_id)
+            VALUES (%s, %s, %s)
+        """, (user_id, action_type, record_id))
+        conn.commit()
+        cur.close()
+
+
+# Liveness: процесс жив и отвечает
+@app.route('/healthz')
+def healthz():
+    return jsonify({"status": "ok"})
+
+
+# Readiness: трафик можно направлять только после прогрева
+@app.route('/readyz')
+def readyz():
+    if not app.config['READY']:
+        return jsonify({"status": "warming up"}), 503
+    return jsonify({"status": "ready"})
 
 
 @app.route('/')
@@ -80,19 +378,25 @@ def add_page():
 @app.route('/list_page')
 @login_required
 def list_page():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("""
-        SELECT * FROM expenses 
-        WHERE user_id = %s 
-        ORDER BY created_at DESC
-    """, (current_user.id,))
-    expenses = cur.fetchall()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        # Токен синхронизации для обновления страницы через /sync (см. sync_expenses)
+        cur.execute("SELECT pg_advisory_xact_lock_shared(%s, %s)", (SYNC_LOCK_SPACE, current_user.id))
+        cur.execute("""
+            SELECT * FROM expenses 
+            WHERE user_id = %s 
+            ORDER BY created_at DESC
+        """, (current_user.id,))
+        expenses = cur.fetchall()
+        # Токен не ниже горизонта компактации, иначе /sync ответит reset и страница
+        # будет перезагружаться бесконечно; все номера пользователя до него уже закоммичены
+        cur.execute("SELECT purged_seq FROM sync_horizon")
+        purged_seq = cur.fetchone()['purged_seq']
+        cur.close()
     
+    sync_token = max([purged_seq] + [expense['change_seq'] for expense in expenses])
     log_audit(current_user.id, "view_list")
-    return render_template('list.html', expenses=expenses)
+    return render_template('list.html', expenses=expenses, sync_token=sync_token)
 
 
 @app.route('/register', methods=['POST'])
@@ -122,40 +426,41 @@ def register():
     
     hashed_password = generate_password_hash(password)
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute(
-            "INSERT INTO users (username, password) VALUES (%s, %s) RETURNING id",
-            (username, hashed_password)
-        )
-        user_id = cur.fetchone()[0]
-        conn.commit()
-        log_audit(user_id, "registration")
-        
-        # Автоматически входим после регистрации
-        user = User(user_id, username)
-        login_user(user)
-        
-        if return_json:
-            return jsonify({"message": "User registered", "user_id": user_id}), 201
-        else:
-            return redirect(url_for('list_page'))  # Перенаправляем на список расходов
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "INSERT INTO users (username, password) VALUES (%s, %s) RETURNING id",
+                (username, hashed_password)
+            )
+            user_id = cur.fetchone()[0]
+            conn.commit()
             
-    except psycopg2.IntegrityError:
-        if return_json:
-            return jsonify({"error": "Username exists"}), 400
-        else:
-            return render_template('register.html', error="Имя пользователя уже существует")
-    except Exception as e:
-        print(f"Error in registration: {e}")
-        if return_json:
-            return jsonify({"error": "Server error"}), 500
-        else:
-            return render_template('register.html', error="Ошибка сервера")
-    finally:
-        cur.close()
-        conn.close()
+        except psycopg2.IntegrityError:
+            if return_json:
+                return jsonify({"error": "Username exists"}), 400
+            else:
+                return render_template('register.html', error="Имя пользователя уже существует")
+        except Exception as e:
+            print(f"Error in registration: {e}")
+            if return_json:
+                return jsonify({"error": "Server error"}), 500
+            else:
+                return render_template('register.html', error="Ошибка сервера")
+        finally:
+            cur.close()
+    
+    # Аудит после возврата соединения: один поток не держит два соединения из пула
+    log_audit(user_id, "registration")
+    
+    # Автоматически входим после регистрации
+    user = User(user_id, username)
+    login_user(user)
+    
+    if return_json:
+        return jsonify({"message": "User registered", "user_id": user_id}), 201
+    else:
+        return redirect(url_for('list_page'))  # Перенаправляем на список расходов
 
 
 @app.route('/login', methods=['POST'])
@@ -170,12 +475,11 @@ def login():
         password = request.form.get('password')
         return_json = False
     
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT * FROM users WHERE username = %s", (username,))
-    user_data = cur.fetchone()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT * FROM users WHERE username = %s", (username,))
+        user_data = cur.fetchone()
+        cur.close()
     
     if user_data and check_password_hash(user_data['password'], password):
         user = User(user_data['id'], user_data['username'])
@@ -209,11 +513,13 @@ def add_expense():
         amount = data.get('amount')
         category = data.get('category')
         description = data.get('description', '')
+        allow_duplicate = bool(data.get('allow_duplicate'))
         return_json = True
     else:
         amount = request.form.get('amount')
         category = request.form.get('category')
         description = request.form.get('description', '')
+        allow_duplicate = bool(request.form.get('allow_duplicate'))
         return_json = False
     
     if not amount or not category:
@@ -235,22 +541,54 @@ def add_expense():
         else:
             return render_template('add.html', error="Введите корректную сумму")
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO expenses (user_id, amount, category, description)
-        VALUES (%s, %s, %s, %s) RETURNING id
-    """, (current_user.id, amount, category, description))
+    fingerprint = expense_fingerprint(current_user.id, amount, category, description)
     
-    expense_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+    
+        # Блокировка по отпечатку, чтобы два одновременных повторных отправления
+        # не прошли проверку оба; снимается при commit
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (fingerprint,))
+        cur.execute("""
+            SELECT id FROM expenses
+            WHERE user_id = %s AND fingerprint = %s
+              AND created_at >= CURRENT_TIMESTAMP - make_interval(mins => %s)
+            ORDER BY created_at DESC
+            LIMIT 1
+        """, (current_user.id, fingerprint, DUPLICATE_WINDOW_MINUTES))
+        duplicate = cur.fetchone()
+        duplicate_of = duplicate[0] if duplicate else None
+    
+        if duplicate_of and DUPLICATE_POLICY == 'reject' and not allow_duplicate:
+            conn.rollback()
+            cur.close()
+            if return_json:
+                return jsonify({"error": "Duplicate expense", "duplicate_of": duplicate_of}), 409
+            else:
+                # Форма заполняется введёнными значениями, пользователь подтверждает флажком
+                return render_template('add.html', error="Такой расход уже добавлен недавно",
+                                       amount=request.form.get('amount'), category=category,
+                                       description=description, confirm_duplicate=True)
+    
+        lock_user_changes(cur, current_user.id)
+        cur.execute("""
+            INSERT INTO expenses (user_id, amount, category, description, fingerprint)
+            VALUES (%s, %s, %s, %s, %s) RETURNING id
+        """, (current_user.id, amount, category, description, fingerprint))
+    
+        expense_id = cur.fetchone()[0]
+        notify_change(cur, current_user.id, "add", expense_id)
+        conn.commit()
+        cur.close()
     
+    category_index.add(current_user.id, category)
     log_audit(current_user.id, "add", expense_id)
     
     if return_json:
-        return jsonify({"message": "Expense added", "expense_id": expense_id}), 201
+        response = {"message": "Expense added", "expense_id": expense_id}
+        if duplicate_of:
+            response["duplicate_of"] = duplicate_of
+        return jsonify(response), 201
     else:
         return redirect(url_for('list_page'))
 
@@ -258,17 +596,16 @@ def add_expense():
 @app.route('/list', methods=['GET'])
 @login_required
 def list_expenses():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("""
-        SELECT * FROM expenses 
-        WHERE user_id = %s 
-        ORDER BY created_at DESC
-    """, (current_user.id,))
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT * FROM expenses 
+            WHERE user_id = %s 
+            ORDER BY created_at DESC
+        """, (current_user.id,))
     
-    expenses = cur.fetchall()
-    cur.close()
-    conn.close()
+        expenses = cur.fetchall()
+        cur.close()
     
     log_audit(current_user.id, "view_list")
     return jsonify({"expenses": expenses})
@@ -289,103 +626,123 @@ def edit_expense(expense_id):
     description = data.get('description')
     
     # Проверка принадлежности записи пользователю
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT user_id FROM expenses WHERE id = %s", (expense_id,))
-    expense = cur.fetchone()
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT user_id, amount, category, description FROM expenses WHERE id = %s", (expense_id,))
+        expense = cur.fetchone()
     
-    if not expense or expense['user_id'] != current_user.id:
-        cur.close()
-        conn.close()
-        if return_json:
-            return jsonify({"error": "Not authorized"}), 403
-        else:
-            return redirect(url_for('list_page'))
+        if not expense or expense['user_id'] != current_user.id:
+            cur.close()
+            if return_json:
+                return jsonify({"error": "Not authorized"}), 403
+            else:
+                return redirect(url_for('list_page'))
     
-    try:
-        # Переданы все поля
-        if amount is not None and category is not None:
-            amount_float = float(amount)
-            if amount_float <= 0:
-                raise ValueError("Amount must be positive")
+        try:
+            lock_user_changes(cur, current_user.id)
             
-            # Безопасный параметризованный запрос
-            cur.execute("""
-                UPDATE expenses 
-                SET amount = %s, category = %s, description = %s 
-                WHERE id = %s
-            """, (amount_float, category, description, expense_id))
+            # Переданы все поля
+            if amount is not None and category is not None:
+                amount_float = float(amount)
+                if amount_float <= 0:
+                    raise ValueError("Amount must be positive")
             
-        # Обновление только суммы
-        elif amount is not None:
-            amount_float = float(amount)
-            if amount_float <= 0:
-                raise ValueError("Amount must be positive")
-            cur.execute("UPDATE expenses SET amount = %s WHERE id = %s", 
-                       (amount_float, expense_id))
+                fingerprint = expense_fingerprint(current_user.id, amount_float, category, description)
             
-        # Обновление только категории
-        elif category is not None:
-            cur.execute("UPDATE expenses SET category = %s WHERE id = %s", 
-                       (category, expense_id))
+                # Безопасный параметризованный запрос
+                cur.execute("""
+                    UPDATE expenses 
+                    SET amount = %s, category = %s, description = %s, fingerprint = %s,
+                        updated_at = CURRENT_TIMESTAMP, change_seq = nextval('expense_change_seq')
+                    WHERE id = %s
+                """, (amount_float, category, description, fingerprint, expense_id))
             
-        # Обновление только описания
-        elif description is not None:
-            cur.execute("UPDATE expenses SET description = %s WHERE id = %s", 
-                       (description, expense_id))
+            # Обновление только суммы
+            elif amount is not None:
+                amount_float = float(amount)
+                if amount_float <= 0:
+                    raise ValueError("Amount must be positive")
+                fingerprint = expense_fingerprint(current_user.id, amount_float,
+                                                  expense['category'], expense['description'])
+                cur.execute("""
+                    UPDATE expenses SET amount = %s, fingerprint = %s,
+                        updated_at = CURRENT_TIMESTAMP, change_seq = nextval('expense_change_seq')
+                    WHERE id = %s
+                """, (amount_float, fingerprint, expense_id))
+            
+            # Обновление только категории
+            elif category is not None:
+                fingerprint = expense_fingerprint(current_user.id, expense['amount'],
+                                                  category, expense['description'])
+                cur.execute("""
+                    UPDATE expenses SET category = %s, fingerprint = %s,
+                        updated_at = CURRENT_TIMESTAMP, change_seq = nextval('expense_change_seq')
+                    WHERE id = %s
+                """, (category, fingerprint, expense_id))
+            
+            # Обновление только описания
+            elif description is not None:
+                fingerprint = expense_fingerprint(current_user.id, expense['amount'],
+                                                  expense['category'], description)
+                cur.execute("""
+                    UPDATE expenses SET description = %s, fingerprint = %s,
+                        updated_at = CURRENT_TIMESTAMP, change_seq = nextval('expense_change_seq')
+                    WHERE id = %s
+                """, (description, fingerprint, expense_id))
             
-        else:
-            if return_json:
-                return jsonify({"error": "No fields to update"}), 400
             else:
-                return redirect(url_for('list_page'))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        log_audit(current_user.id, "edit", expense_id)
+                if return_json:
+                    return jsonify({"error": "No fields to update"}), 400
+                else:
+                    return redirect(url_for('list_page'))
         
-        if return_json:
-            return jsonify({"message": "Expense updated"})
-        else:
-            return redirect(url_for('list_page'))
+            notify_change(cur, current_user.id, "edit", expense_id)
+            conn.commit()
             
-    except ValueError as e:
-        cur.close()
-        conn.close()
-        if return_json:
-            return jsonify({"error": str(e)}), 400
-        else:
-            return redirect(url_for('list_page'))
-    except Exception as e:
-        cur.close()
-        conn.close()
-        if return_json:
-            return jsonify({"error": "Server error"}), 500
-        else:
-            return redirect(url_for('list_page'))
+        except ValueError as e:
+            if return_json:
+                return jsonify({"error": str(e)}), 400
+            else:
+                return redirect(url_for('list_page'))
+        except Exception as e:
+            if return_json:
+                return jsonify({"error": "Server error"}), 500
+            else:
+                return redirect(url_for('list_page'))
+        finally:
+            cur.close()
+    
+    if category is not None and category != expense['category']:
+        category_index.remove(current_user.id, expense['category'])
+        category_index.add(current_user.id, category)
+    log_audit(current_user.id, "edit", expense_id)
+    
+    if return_json:
+        return jsonify({"message": "Expense updated"})
+    else:
+        return redirect(url_for('list_page'))
 
 
 @app.route('/delete/<int:expense_id>', methods=['POST'])
 @login_required
 def delete_expense(expense_id):
     # Проверка принадлежности
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT user_id FROM expenses WHERE id = %s", (expense_id,))
-    expense = cur.fetchone()
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT user_id FROM expenses WHERE id = %s", (expense_id,))
+        expense = cur.fetchone()
     
-    if not expense or expense['user_id'] != current_user.id:
-        cur.close()
-        conn.close()
-        return jsonify({"error": "Not authorized"}), 403
+        if not expense or expense['user_id'] != current_user.id:
+            cur.close()
+            return jsonify({"error": "Not authorized"}), 403
     
-    cur.execute("DELETE FROM expenses WHERE id = %s", (expense_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+        category, orphaned = remove_expense(cur, current_user.id, expense_id)
+        conn.commit()
+        cur.close()
     
+    if orphaned:
+        remove_orphaned_attachments(orphaned)
+    category_index.remove(current_user.id, category)
     log_audit(current_user.id, "delete", expense_id)
     return jsonify({"message": "Expense deleted"})
 
@@ -393,33 +750,309 @@ def delete_expense(expense_id):
 @app.route('/audit', methods=['GET'])
 @login_required
 def get_audit():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("""
-        SELECT * FROM audit_log 
-        WHERE user_id = %s 
-        ORDER BY action_time DESC
-    """, (current_user.id,))
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT * FROM audit_log 
+            WHERE user_id = %s 
+            ORDER BY action_time DESC
+        """, (current_user.id,))
     
-    audit_logs = cur.fetchall()
-    cur.close()
-    conn.close()
+        audit_logs = cur.fetchall()
+        cur.close()
     
     return jsonify({"audit_logs": audit_logs})
 
 
+# Инкрементальная синхронизация: только изменения с момента токена
+@app.route('/sync', methods=['GET'])
+@login_required
+def sync_expenses():
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({"error": "Invalid sync token"}), 400
+
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+
+        # Ждём незавершённые изменения пользователя (см. lock_user_changes); блокировка
+        # держится до конца чтения, поэтому новые изменения получат номера больше токена
+        cur.execute("SELECT pg_advisory_xact_lock_shared(%s, %s)", (SYNC_LOCK_SPACE, current_user.id))
+
+        # Надгробия старше горизонта уже удалены: такой клиент получает полный список заново
+        cur.execute("SELECT purged_seq FROM sync_horizon")
+        purged_seq = cur.fetchone()['purged_seq']
+        reset = since < purged_seq
+        if reset:
+            since = 0
+
+        cur.execute("""
+            SELECT * FROM expenses
+            WHERE user_id = %s AND change_seq > %s
+            ORDER BY change_seq
+        """, (current_user.id, since))
+        upserts = cur.fetchall()
+
+        deleted = []
+        if not reset:
+            cur.execute("""
+                SELECT expense_id, change_seq FROM expense_tombstones
+                WHERE user_id = %s AND change_seq > %s
+                ORDER BY change_seq
+            """, (current_user.id, since))
+            deleted = cur.fetchall()
+
+        cur.close()
+
+    token = max([since] + [row['change_seq'] for row in upserts] + [row['change_seq'] for row in deleted])
+    # После полного списка токен не ниже горизонта, иначе следующий запрос снова получит reset;
+    # под блокировкой все номера пользователя до горизонта уже закоммичены
+    if reset:
+        token = max(token, purged_seq)
+    return jsonify({
+        "reset": reset,
+        "upserts": upserts,
+        "deleted": [row['expense_id'] for row in deleted],
+        "token": token
+    })
+
+
+# Загрузка вложения: тело запроса пишется на диск блоками, без чтения целиком в память
+@app.route('/expenses/<int:expense_id>/attachments', methods=['POST'])
+@login_required
+def upload_attachment(expense_id):
+    content_type = (request.mimetype or '').lower()
+    filename = os.path.basename(request.headers.get('X-Filename') or request.args.get('filename') or 'receipt')[:255]
+
+    if content_type not in ATTACHMENT_TYPES:
+        return jsonify({"error": "Unsupported file type"}), 415
+    if request.content_length is not None and request.content_length > MAX_ATTACHMENT_SIZE:
+        return jsonify({"error": "File too large"}), 413
+
+    # Проверка принадлежности до чтения тела; соединение не держим во время загрузки
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT user_id FROM expenses WHERE id = %s", (expense_id,))
+        expense = cur.fetchone()
+        cur.close()
+
+    if not expense or expense['user_id'] != current_user.id:
+        return jsonify({"error": "Not authorized"}), 403
+
+    os.makedirs(ATTACHMENTS_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    tmp = tempfile.NamedTemporaryFile(dir=ATTACHMENTS_DIR, prefix='upload_', delete=False)
+    try:
+        with tmp:
+            while True:
+                chunk = request.stream.read(ATTACHMENT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_ATTACHMENT_SIZE:
+                    return jsonify({"error": "File too large"}), 413
+                digest.update(chunk)
+                tmp.write(chunk)
+
+        if size == 0:
+            return jsonify({"error": "Empty file"}), 400
+
+        sha256 = digest.hexdigest()
+        path = attachment_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with get_db_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            try:
+                # DO UPDATE блокирует строку, чтобы параллельное удаление не убрало файл
+                cur.execute("""
+                    INSERT INTO attachments (sha256, size, content_type)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (sha256) DO UPDATE SET size = EXCLUDED.size
+                """, (sha256, size, content_type))
+                cur.execute("""
+                    INSERT INTO expense_attachments (expense_id, sha256, filename)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT DO NOTHING
+                    RETURNING sha256
+                """, (expense_id, sha256, filename))
+                if cur.fetchone():
+                    cur.execute("UPDATE attachments SET ref_count = ref_count + 1 WHERE sha256 = %s", (sha256,))
+
+                # Одинаковое содержимое хранится один раз
+                if not os.path.exists(path):
+                    os.replace(tmp.name, path)
+                conn.commit()
+            except psycopg2.IntegrityError:
+                # Расход удалили во время загрузки
+                conn.rollback()
+                return jsonify({"error": "Expense not found"}), 404
+            finally:
+                cur.close()
+    finally:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+
+    log_audit(current_user.id, "attach", expense_id)
+    return jsonify({
+        "message": "Attachment uploaded",
+        "sha256": sha256,
+        "url": url_for('download_attachment', expense_id=expense_id, sha256=sha256)
+    }), 201
+
+
+# Список вложений расхода
+@app.route('/expenses/<int:expense_id>/attachments', methods=['GET'])
+@login_required
+def list_attachments(expense_id):
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT ea.sha256, ea.filename, a.size, a.content_type, ea.created_at
+            FROM expense_attachments ea
+            JOIN expenses e ON e.id = ea.expense_id
+            JOIN attachments a ON a.sha256 = ea.sha256
+            WHERE ea.expense_id = %s AND e.user_id = %s
+            ORDER BY ea.created_at
+        """, (expense_id, current_user.id))
+        attachments = cur.fetchall()
+        cur.close()
+
+    for attachment in attachments:
+        attachment['url'] = url_for('download_attachment', expense_id=expense_id, sha256=attachment['sha256'])
+    return jsonify({"attachments": attachments})
+
+
+# Скачивание вложения: send_file поддерживает If-None-Match и Range
+@app.route('/expenses/<int:expense_id>/attachments/<sha256>', methods=['GET'])
+@login_required
+def download_attachment(expense_id, sha256):
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256):
+        return jsonify({"error": "Attachment not found"}), 404
+
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT ea.filename, a.content_type
+            FROM expense_attachments ea
+            JOIN expenses e ON e.id = ea.expense_id
+            JOIN attachments a ON a.sha256 = ea.sha256
+            WHERE ea.expense_id = %s AND ea.sha256 = %s AND e.user_id = %s
+        """, (expense_id, sha256, current_user.id))
+        attachment = cur.fetchone()
+        cur.close()
+
+    path = attachment_path(sha256)
+    if not attachment or not os.path.exists(path):
+        return jsonify({"error": "Attachment not found"}), 404
+
+    # Содержимое по хешу неизменно, поэтому хеш - готовый ETag. Чеки личные: общие кеши
+    # (прокси, CDN) их не сохраняют, браузер перепроверяет копию по ETag и получает 304
+    response = send_file(path, mimetype=attachment['content_type'], download_name=attachment['filename'],
+                         conditional=True, etag=sha256)
+    response.cache_control.private = True
+    return response
+
+
+# Отчёт о дубликатах: расходы с одинаковым отпечатком, добавленные подряд
+# с интервалом не больше окна, объединяются в группы одним запросом
+@app.route('/duplicates', methods=['GET'])
+@login_required
+def duplicates_report():
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            WITH ordered AS (
+                SELECT id, fingerprint, amount, category, created_at,
+                       CASE WHEN created_at - LAG(created_at) OVER w <= make_interval(mins => %s)
+                            THEN 0 ELSE 1 END AS starts_group
+                FROM expenses
+                WHERE user_id = %s AND fingerprint IS NOT NULL
+                WINDOW w AS (PARTITION BY fingerprint ORDER BY created_at, id)
+            ), grouped AS (
+                SELECT *, SUM(starts_group) OVER (PARTITION BY fingerprint ORDER BY created_at, id) AS group_no
+                FROM ordered
+            )
+            SELECT MIN(amount) AS amount, MIN(category) AS category,
+                   array_agg(id ORDER BY created_at, id) AS expense_ids,
+                   MIN(created_at) AS first_at, MAX(created_at) AS last_at
+            FROM grouped
+            GROUP BY fingerprint, group_no
+            HAVING COUNT(*) > 1
+            ORDER BY last_at DESC
+        """, (DUPLICATE_WINDOW_MINUTES, current_user.id))
+        groups = cur.fetchall()
+        cur.close()
+
+    return jsonify({"duplicates": groups, "window_minutes": DUPLICATE_WINDOW_MINUTES})
+
+
+# Подсказки категорий по префиксу, отсортированные по частоте
+@app.route('/categories/suggest', methods=['GET'])
+@login_required
+def suggest_categories():
+    prefix = request.args.get('prefix', '')
+    try:
+        limit = min(int(request.args.get('limit', 10)), 50)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+
+    # Индекс в памяти актуален, только пока процесс слушает уведомления об изменениях
+    change_feed.start()
+    return jsonify({"suggestions": category_index.suggest(current_user.id, prefix, limit)})
+
+
+# Поток изменений расходов (Server-Sent Events) вместо опроса /list
+@app.route('/events')
+@login_required
+def events():
+    subscriber = change_feed.subscribe(current_user.id)
+    if subscriber is None:
+        return jsonify({"error": "Too many event streams"}), 503, {"Retry-After": "30"}
+
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                if subscriber.overflowed:
+                    # Клиент не успевал читать: просим перечитать список целиком
+                    yield "event: resync\ndata: {}\n\n"
+                    return
+                if subscriber.closed:
+                    # Воркер останавливается: клиент быстро переподключится к другому
+                    # и доберёт пропущенное через /sync при открытии потока
+                    yield f"retry: {SSE_RECONNECT_DELAY}\n\n"
+                    return
+                try:
+                    payload = subscriber.queue.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if payload is None:
+                    continue
+                yield f"event: change\ndata: {payload}\n\n"
+        finally:
+            change_feed.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
 # Страница редактирования расхода
 @app.route('/edit_page/<int:expense_id>')
 @login_required
 def edit_page(expense_id):
     
     # Проверка принадлежности
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT * FROM expenses WHERE id = %s", (expense_id,))
-    expense = cur.fetchone()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT * FROM expenses WHERE id = %s", (expense_id,))
+        expense = cur.fetchone()
+        cur.close()
     
     if not expense or expense['user_id'] != current_user.id:
         return redirect(url_for('list_page'))
@@ -431,23 +1064,12 @@ def edit_page(expense_id):
 @app.route('/update_expense/<int:expense_id>', methods=['POST'])
 @login_required
 def update_expense(expense_id):
-    # Проверка принадлежности
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT user_id FROM expenses WHERE id = %s", (expense_id,))
-    expense = cur.fetchone()
-    
-    if not expense or expense['user_id'] != current_user.id:
-        cur.close()
-        conn.close()
-        return redirect(url_for('list_page'))
-    
     # Получаем данные из формы
     amount = request.form.get('amount')
     category = request.form.get('category')
     description = request.form.get('description', '')
     
-    # Проверяем данные
+    # Проверяем данные до открытия соединения, чтобы не держать его из пула
     if not amount or not category:
         return redirect(url_for('edit_page', expense_id=expense_id))
     
@@ -458,17 +1080,33 @@ def update_expense(expense_id):
     except ValueError:
         return redirect(url_for('edit_page', expense_id=expense_id))
     
-    # Обновляем запись
-    cur.execute("""
-        UPDATE expenses 
-        SET amount = %s, category = %s, description = %s
-        WHERE id = %s
-    """, (amount, category, description, expense_id))
+    # Проверка принадлежности
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT user_id, amount, category, description FROM expenses WHERE id = %s", (expense_id,))
+        expense = cur.fetchone()
+    
+        if not expense or expense['user_id'] != current_user.id:
+            cur.close()
+            return redirect(url_for('list_page'))
+    
+        # Обновляем запись
+        fingerprint = expense_fingerprint(current_user.id, amount, category, description)
+        lock_user_changes(cur, current_user.id)
+        cur.execute("""
+            UPDATE expenses 
+            SET amount = %s, category = %s, description = %s, fingerprint = %s,
+                updated_at = CURRENT_TIMESTAMP, change_seq = nextval('expense_change_seq')
+            WHERE id = %s
+        """, (amount, category, description, fingerprint, expense_id))
     
-    conn.commit()
-    cur.close()
-    conn.close()
+        notify_change(cur, current_user.id, "edit", expense_id)
+        conn.commit()
+        cur.close()
     
+    if category != expense['category']:
+        category_index.remove(current_user.id, expense['category'])
+        category_index.add(current_user.id, category)
     log_audit(current_user.id, "edit", expense_id)
     return redirect(url_for('list_page'))
 
@@ -478,26 +1116,133 @@ def update_expense(expense_id):
 @login_required
 def delete_html(expense_id):
     # Проверка принадлежности
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT user_id FROM expenses WHERE id = %s", (expense_id,))
-    expense = cur.fetchone()
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT user_id FROM expenses WHERE id = %s", (expense_id,))
+        expense = cur.fetchone()
     
-    if not expense or expense['user_id'] != current_user.id:
-        cur.close()
-        conn.close()
-        return redirect(url_for('list_page'))
+        if not expense or expense['user_id'] != current_user.id:
+            cur.close()
+            return redirect(url_for('list_page'))
     
-    cur.execute("DELETE FROM expenses WHERE id = %s", (expense_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+        category, orphaned = remove_expense(cur, current_user.id, expense_id)
+        conn.commit()
+        cur.close()
     
+    if orphaned:
+        remove_orphaned_attachments(orphaned)
+    category_index.remove(current_user.id, category)
     log_audit(current_user.id, "delete", expense_id)
-    return redirect(url_for('list_page')) 
+    return redirect(url_for('list_page'))
+
+
+# Постановка фоновой задачи (выгрузка всей истории или годовой отчёт)
+@app.route('/jobs', methods=['POST'])
+@login_required
+def submit_job():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "JSON object required"}), 400
+    kind = data.get('kind')
+    params = data.get('params') or {}
+    if not isinstance(params, dict):
+        return jsonify({"error": "Job params must be an object"}), 400
+
+    if kind not in JOB_KINDS:
+        return jsonify({"error": "Unknown job kind"}), 400
+
+    if kind == 'report':
+        try:
+            params = {"year": int(params.get('year'))}
+        except (TypeError, ValueError):
+            return jsonify({"error": "Report year required"}), 400
+    else:
+        params = {}
+
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO jobs (user_id, kind, params)
+            VALUES (%s, %s, %s) RETURNING id
+        """, (current_user.id, kind, json.dumps(params)))
+        job_id = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+
+    log_audit(current_user.id, "job_submit", job_id)
+    return jsonify({"message": "Job queued", "job_id": job_id}), 202
+
+
+# Статус и прогресс задачи
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def job_status(job_id):
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT id, kind, status, progress, error, created_at, started_at, finished_at, expires_at
+            FROM jobs
+            WHERE id = %s AND user_id = %s
+        """, (job_id, current_user.id))
+        job = cur.fetchone()
+        cur.close()
+
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+
+    if job['status'] == 'done':
+        job['download_url'] = url_for('download_job', job_id=job_id)
+    return jsonify({"job": job})
+
+
+# Отмена задачи: ожидающая отменяется сразу, выполняющуюся останавливает воркер
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            UPDATE jobs
+            SET cancel_requested = TRUE,
+                status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+                finished_at = CASE WHEN status = 'queued' THEN CURRENT_TIMESTAMP ELSE finished_at END
+            WHERE id = %s AND user_id = %s AND status IN ('queued', 'running')
+            RETURNING status
+        """, (job_id, current_user.id))
+        job = cur.fetchone()
+        conn.commit()
+        cur.close()
+
+    if not job:
+        return jsonify({"error": "Job not found or already finished"}), 409
+
+    log_audit(current_user.id, "job_cancel", job_id)
+    return jsonify({"message": "Cancellation requested", "status": job['status']})
+
+
+# Скачивание результата готовой задачи
+@app.route('/jobs/<int:job_id>/download', methods=['GET'])
+@login_required
+def download_job(job_id):
+    with get_db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT kind, status, result_path FROM jobs
+            WHERE id = %s AND user_id = %s
+        """, (job_id, current_user.id))
+        job = cur.fetchone()
+        cur.close()
+
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if job['status'] != 'done' or not job['result_path'] or not os.path.exists(job['result_path']):
+        return jsonify({"error": "Result not available", "status": job['status']}), 409
+
+    download_name = f"{job['kind']}_{job_id}{os.path.splitext(job['result_path'])[1]}"
+    return send_file(job['result_path'], as_attachment=True, download_name=download_name)
 
 
 if __name__ == '__main__':
-    from models import create_tables
-    create_tables()
+    # Схема создаётся отдельно (python models.py), здесь только проверка и прогрев
+    warm_up()
     app.run(debug=False)
@@ -0,0 +1,127 @@
+# Сравнение production-сервера (gunicorn) с dev-сервером Flask.
+#
+# Запуск: python bench_server.py [--duration 10] [--concurrency 16]
+# Скрипт поднимает оба сервера, ждёт /readyz и нагружает одни и те же
+# страницы в N потоков, затем печатает таблицу с RPS и задержками.
+# /list нагружается от имени тестового пользователя с заранее добавленными
+# расходами: это единственный путь, который обращается к пулу соединений с БД.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+SERVERS = {
+    'dev (app.run)': (
+        [sys.executable, '-c', 'import app; app.warm_up(); app.app.run(port=5001, threaded=True)'],
+        'http://127.0.0.1:5001',
+    ),
+    'gunicorn': (
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', '127.0.0.1:8001'],
+        'http://127.0.0.1:8001',
+    ),
+}
+
+PATHS = ['/healthz', '/login_page', '/list']
+
+BENCH_USER = {'username': 'bench_user', 'password': 'bench_password'}
+SEED_EXPENSES = 50
+
+
+def wait_ready(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(base_url + '/readyz', timeout=1) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Сервер {base_url} не стал готов за {timeout} с")
+
+
+def post_json(url, data, cookie=None):
+    request = urllib.request.Request(url, data=json.dumps(data).encode(), method='POST',
+                                     headers={'Content-Type': 'application/json'})
+    if cookie:
+        request.add_header('Cookie', cookie)
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return response.headers.get('Set-Cookie', '').split(';')[0]
+
+
+def login(base_url):
+    # Регистрирует пользователя при первом запуске и добавляет ему расходы,
+    # иначе просто входит; возвращает cookie сессии
+    try:
+        cookie = post_json(base_url + '/register', BENCH_USER)
+    except urllib.error.HTTPError as e:
+        if e.code != 400:
+            raise
+        return post_json(base_url + '/login', BENCH_USER)
+
+    for i in range(SEED_EXPENSES):
+        post_json(base_url + '/add', {'amount': 100 + i, 'category': 'Еда', 'description': f'bench {i}',
+                                      'allow_duplicate': True}, cookie)
+    return cookie
+
+
+def worker(url, deadline, cookie):
+    latencies = []
+    errors = 0
+    request = urllib.request.Request(url, headers={'Cookie': cookie})
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                response.read()
+            latencies.append(time.perf_counter() - start)
+        except (urllib.error.URLError, ConnectionError):
+            errors += 1
+    return latencies, errors
+
+
+def run_load(url, duration, concurrency, cookie):
+    deadline = time.monotonic() + duration
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: worker(url, deadline, cookie), range(concurrency)))
+
+    latencies = sorted(l for worker_latencies, _ in results for l in worker_latencies)
+    errors = sum(e for _, e in results)
+    if not latencies:
+        return 0, 0, 0, errors
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    return len(latencies) / duration, p50, p99, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    rows = []
+    for name, (command, base_url) in SERVERS.items():
+        process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(base_url)
+            cookie = login(base_url)
+            for path in PATHS:
+                rows.append((name, path) + run_load(base_url + path, args.duration, args.concurrency, cookie))
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(f"{'сервер':<16}{'путь':<14}{'RPS':>10}{'p50, мс':>10}{'p99, мс':>10}{'ошибки':>8}")
+    for name, path, rps, p50, p99, errors in rows:
+        print(f"{name:<16}{path:<14}{rps:>10.0f}{p50:>10.1f}{p99:>10.1f}{errors:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import bisect
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_category(category):
+    # Ключ категории: без регистра и лишних пробелов.
+    # Тот же ключ входит в отпечаток расхода (models.expense_fingerprint)
+    return ' '.join(str(category).split()).casefold()
+
+
+class UserCategories:
+    # Категории одного пользователя: отсортированные ключи для поиска по префиксу
+    # и частоты для ранжирования
+    def __init__(self, rows):
+        self.keys = []
+        self.entries = {}
+        for category, count in rows:
+            self.add(category, count)
+
+    def add(self, category, count=1):
+        key = normalize_category(category)
+        if not key:
+            return
+        entry = self.entries.get(key)
+        if entry is None:
+            bisect.insort(self.keys, key)
+            self.entries[key] = [category.strip(), count]
+        else:
+            entry[1] += count
+
+    def remove(self, category):
+        key = normalize_category(category)
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self.entries[key]
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def suggest(self, prefix, limit):
+        prefix = normalize_category(prefix)
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + '\U0010ffff')
+        ranked = heapq.nsmallest(limit, self.keys[start:end],
+                                 key=lambda key: (-self.entries[key][1], key))
+        return [self.entries[key][0] for key in ranked]
+
+
+class CategoryIndex:
+    # Индекс категорий в памяти процесса: загружается лениво для каждого пользователя,
+    # обновляется при добавлении, изменении и удалении расходов, ограничен LRU по пользователям.
+    # Изменения из других процессов приходят через invalidate; ttl - страховка на случай
+    # пропущенных уведомлений
+    def __init__(self, loader, max_users=1000, ttl=None):
+        self.loader = loader
+        self.max_users = max_users
+        self.ttl = ttl
+        self.reset()
+
+    def reset(self):
+        # Вызывается после fork: состояние родительского процесса не наследуется
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+        # Загрузки в процессе: user_id -> [число загрузок, число изменений с их начала]
+        self._loading = {}
+
+    def suggest(self, user_id, prefix, limit=10):
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached is not None and not self._expired(cached):
+                self._users.move_to_end(user_id)
+                return cached[1].suggest(prefix, limit)
+            loading = self._loading.setdefault(user_id, [0, 0])
+            loading[0] += 1
+            changes_before = loading[1]
+
+        # Загрузка из БД вне блокировки, чтобы не задерживать других пользователей
+        try:
+            loaded = UserCategories(self.loader(user_id))
+        finally:
+            with self._lock:
+                loading = self._loading[user_id]
+                loading[0] -= 1
+                changed = loading[1] != changes_before
+                if loading[0] == 0:
+                    del self._loading[user_id]
+
+        with self._lock:
+            # Изменение, закоммиченное во время загрузки, могло не попасть в снимок:
+            # отвечаем по нему, но не кешируем, следующий запрос загрузит заново
+            if changed:
+                return loaded.suggest(prefix, limit)
+            self._users[user_id] = (time.monotonic(), loaded)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+            return loaded.suggest(prefix, limit)
+
+    def add(self, user_id, category):
+        # Незагруженных пользователей не трогаем: при первом запросе данные придут из БД
+        with self._lock:
+            self._changed(user_id)
+            cached = self._users.get(user_id)
+            if cached is not None:
+                cached[1].add(category)
+
+    def remove(self, user_id, category):
+        with self._lock:
+            self._changed(user_id)
+            cached = self._users.get(user_id)
+            if cached is not None:
+                cached[1].remove(category)
+
+    def invalidate(self, user_id=None):
+        # Сбрасывает пользователя (None - всех): следующий запрос загрузит данные из БД
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+                for loading in self._loading.values():
+                    loading[1] += 1
+            else:
+                self._users.pop(user_id, None)
+                self._changed(user_id)
+
+    def _changed(self, user_id):
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            loading[1] += 1
+
+    def _expired(self, cached):
+        return self.ttl is not None and time.monotonic() - cached[0] > self.ttl
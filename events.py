@@ -0,0 +1,142 @@
+import json
+import os
+import queue
+import secrets
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+# Канал PostgreSQL, в который пишут изменения расходов
+CHANGES_CHANNEL = 'expense_changes'
+
+
+class Subscriber:
+    # Подписка одного открытого SSE-потока с ограниченным буфером
+    def __init__(self, user_id, buffer_size):
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.overflowed = False
+        self.closed = False
+
+
+class ChangeFeed:
+    # Одно LISTEN-соединение на процесс раздаёт уведомления подписчикам пользователя.
+    # max_subscribers ограничивает число открытых потоков в процессе: каждый из них
+    # занимает поток сервера, пока клиент подключён
+    def __init__(self, db_config, buffer_size=100, max_subscribers=None):
+        self.db_config = db_config
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._callbacks = []
+        self.reset()
+
+    def reset(self):
+        # Вызывается после fork: поток слушателя и подписки родителя не наследуются.
+        # origin помечает уведомления этого процесса; случайная часть отличает
+        # процессы с одинаковым pid после перезапуска
+        self.origin = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._count = 0
+        self._thread = None
+        self.stopping = threading.Event()
+
+    def add_callback(self, callback):
+        # Обработчик уведомлений других процессов, помимо SSE-подписчиков: свои изменения
+        # процесс уже применил сам. Получает user_id изменения или None после
+        # (пере)подключения слушателя, когда уведомления могли быть пропущены
+        self._callbacks.append(callback)
+
+    def start(self):
+        self._ensure_listener()
+
+    def subscribe(self, user_id):
+        # Возвращает None, если лимит подписчиков процесса исчерпан
+        self._ensure_listener()
+        subscriber = Subscriber(user_id, self.buffer_size)
+        with self._lock:
+            if self.stopping.is_set():
+                return None
+            if self.max_subscribers is not None and self._count >= self.max_subscribers:
+                return None
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+            self._count += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_id)
+            if subscribers and subscriber in subscribers:
+                subscribers.discard(subscriber)
+                self._count -= 1
+                if not subscribers:
+                    del self._subscribers[subscriber.user_id]
+
+    def stop(self):
+        # Остановка процесса: открытые потоки завершаются сразу, а не по graceful_timeout,
+        # и клиенты переподключаются к живому воркеру. None будит поток, ждущий очередь
+        self.stopping.set()
+        with self._lock:
+            subscribers = [subscriber for group in self._subscribers.values() for subscriber in group]
+        for subscriber in subscribers:
+            subscriber.closed = True
+            try:
+                subscriber.queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def dispatch(self, payload):
+        change = json.loads(payload)
+        user_id = change.get('user_id')
+        if change.get('origin') != self.origin:
+            self._notify_callbacks(user_id)
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(payload)
+            except queue.Full:
+                # Медленный клиент: отключаем, после переподключения он перечитает список
+                subscriber.overflowed = True
+                self.unsubscribe(subscriber)
+
+    def _notify_callbacks(self, user_id):
+        for callback in self._callbacks:
+            try:
+                callback(user_id)
+            except Exception as e:
+                print(f"Error in change feed callback: {e}")
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, daemon=True)
+                self._thread.start()
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.db_config)
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {CHANGES_CHANNEL}")
+                cur.close()
+                self._notify_callbacks(None)
+
+                while True:
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.dispatch(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"Error in change feed listener: {e}")
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    conn.close()
@@ -0,0 +1,106 @@
+# Конфигурация production-сервера: gunicorn -c gunicorn.conf.py
+#
+# Сигналы:
+#   HUP  - плавный перезапуск: новые воркеры с перечитанным конфигом и кодом,
+#          старые дорабатывают текущие запросы
+#   TERM - плавная остановка с ожиданием активных запросов (graceful_timeout)
+import multiprocessing
+import os
+import threading
+import time
+
+wsgi_app = 'app:app'
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+
+# Префорк: процессы-воркеры, в каждом пул потоков
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', '4'))
+
+# Бюджет соединений с PostgreSQL на все веб-воркеры. Воркер держит до DB_POOL_MAX
+# соединений пула (не меньше threads, см. init_worker) и одно LISTEN-соединение.
+# По умолчанию 80 из стандартных max_connections=100: остальное - фоновому воркеру
+# задач (worker.py) и администрированию. Воркеры сверх бюджета не прошли бы прогрев
+# и бесконечно повторяли бы его, не становясь готовыми
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', '80'))
+
+
+def connections_per_worker(threads):
+    pool_min = max(int(os.environ.get('DB_POOL_MIN', threads)), threads)
+    return max(pool_min, int(os.environ.get('DB_POOL_MAX', '10'))) + 1
+
+
+# 2 * CPU + 1 воркеров, но не больше, чем позволяет бюджет соединений
+workers = int(os.environ.get('WEB_WORKERS', min(
+    multiprocessing.cpu_count() * 2 + 1,
+    max(1, DB_MAX_CONNECTIONS // connections_per_worker(threads))
+)))
+
+# SSE (/events): каждый открытый поток изменений занимает поток воркера целиком.
+# На воркер допускается SSE_MAX_STREAMS потоков (по умолчанию threads // 2),
+# всего workers * SSE_MAX_STREAMS открытых вкладок; остальные вкладки опрашивают /sync.
+# Для большого числа вкладок /events лучше вынести в отдельный экземпляр с большим
+# WEB_THREADS и направить его туда на прокси, не увеличивая потоки основного
+
+# Перезапуск воркера после N запросов ограничивает рост памяти;
+# jitter разносит перезапуски воркеров во времени
+max_requests = int(os.environ.get('MAX_REQUESTS', '1000'))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', '100'))
+
+timeout = int(os.environ.get('WORKER_TIMEOUT', '60'))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+
+# Приложение загружается в каждом воркере после fork, а не в мастере:
+# так HUP подхватывает новый код, а соединения с БД не делятся между процессами
+preload_app = False
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    # Проверка с учётом параметров командной строки (--workers, --threads)
+    check_connection_budget(server.cfg)
+
+
+def check_connection_budget(cfg):
+    needed = cfg.workers * connections_per_worker(cfg.threads)
+    if needed > DB_MAX_CONNECTIONS:
+        raise RuntimeError(
+            f"{cfg.workers} воркеров по {connections_per_worker(cfg.threads)} соединений = {needed}, "
+            f"больше DB_MAX_CONNECTIONS={DB_MAX_CONNECTIONS}: уменьшите WEB_WORKERS или DB_POOL_MAX"
+        )
+
+
+def post_worker_init(worker):
+    # Пул соединений, шаблоны и частые запросы прогреваются в самом воркере
+    from app import init_worker
+    init_worker(threads=worker.cfg.threads)
+    threading.Thread(target=_stop_streams_on_exit, args=(worker,), daemon=True).start()
+
+
+def _stop_streams_on_exit(worker):
+    # SSE-поток сам не завершается, и без остановки каждый HUP, TERM и перезапуск
+    # по max_requests ждал бы весь graceful_timeout. Все они сбрасывают worker.alive
+    # (max_requests - без сигнала), поэтому следим за флагом
+    while worker.alive:
+        time.sleep(0.5)
+    from app import change_feed
+    change_feed.stop()
+
+
+def worker_int(worker):
+    # INT/QUIT: быстрая остановка
+    from app import change_feed
+    change_feed.stop()
+
+
+def worker_abort(worker):
+    # ABRT: воркер завис и будет убит по timeout
+    from app import change_feed
+    change_feed.stop()
+
+
+def worker_exit(server, worker):
+    from app import close_worker
+    close_worker()
@@ -1,5 +1,20 @@
+import hashlib
+from decimal import Decimal, ROUND_HALF_UP
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_batch
+from categories import normalize_category
+
+# Версия схемы; увеличивается при каждом изменении таблиц ниже
+SCHEMA_VERSION = 6
+
+def expense_fingerprint(user_id, amount, category, description):
+    # Нормализованный отпечаток расхода для поиска дубликатов:
+    # сумма до копеек, категория и описание без регистра и лишних пробелов
+    amount = Decimal(str(amount)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    category = normalize_category(category)
+    description = normalize_category(description or '')
+    key = f"{user_id}|{amount}|{category}|{description}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
 
 def create_tables():
     conn = psycopg2.connect(
@@ -31,6 +46,84 @@ def create_tables():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
+
+    # Индекс для списка расходов пользователя (WHERE user_id ORDER BY created_at DESC)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_created
+        ON expenses (user_id, created_at DESC)
+    """)
+
+    # Синхронизация: время и номер последнего изменения каждой записи.
+    # ALTER, а не CREATE, чтобы колонки появились и в уже существующих базах
+    cur.execute("CREATE SEQUENCE IF NOT EXISTS expense_change_seq")
+    cur.execute("""
+        ALTER TABLE expenses
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT nextval('expense_change_seq')
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_change_seq
+        ON expenses (user_id, change_seq)
+    """)
+
+    # Отпечаток для поиска дубликатов; индекс покрывает проверку окна по времени
+    cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS fingerprint CHAR(64)")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_fingerprint
+        ON expenses (user_id, fingerprint, created_at)
+    """)
+    cur.execute("SELECT id, user_id, amount, category, description FROM expenses WHERE fingerprint IS NULL")
+    execute_batch(cur, "UPDATE expenses SET fingerprint = %s WHERE id = %s", [
+        (expense_fingerprint(user_id, amount, category, description), expense_id)
+        for expense_id, user_id, amount, category, description in cur.fetchall()
+    ])
+
+    # Надгробия удалённых расходов для синхронизации
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS expense_tombstones (
+            expense_id INTEGER PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id),
+            change_seq BIGINT NOT NULL,
+            deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tombstones_user_change_seq
+        ON expense_tombstones (user_id, change_seq)
+    """)
+
+    # Горизонт компактации: надгробия с номером не больше purged_seq уже удалены
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS sync_horizon (
+            purged_seq BIGINT NOT NULL
+        )
+    """)
+    cur.execute("""
+        INSERT INTO sync_horizon (purged_seq)
+        SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM sync_horizon)
+    """)
+    
+    # Вложения (чеки): файлы хранятся по SHA-256, одинаковые файлы - один раз
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS attachments (
+            sha256 CHAR(64) PRIMARY KEY,
+            size BIGINT NOT NULL,
+            content_type VARCHAR(100) NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Связь расходов с вложениями; ref_count в attachments - число таких связей
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS expense_attachments (
+            expense_id INTEGER REFERENCES expenses(id) ON DELETE CASCADE,
+            sha256 CHAR(64) REFERENCES attachments(sha256),
+            filename VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (expense_id, sha256)
+        )
+    """)
     
     # Таблица аудита
     cur.execute("""
@@ -42,11 +135,76 @@ def create_tables():
             action_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
-    
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_audit_log_user_time
+        ON audit_log (user_id, action_time DESC)
+    """)
+
+    # Таблица фоновых задач (выгрузки, отчёты)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id),
+            kind VARCHAR(20) NOT NULL,
+            params TEXT,
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            progress INTEGER NOT NULL DEFAULT 0,
+            result_path TEXT,
+            error TEXT,
+            cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            expires_at TIMESTAMP
+        )
+    """)
+
+    # Аренда задачи: воркер продлевает heartbeat_at, пока задача выполняется;
+    # attempts ограничивает повторы задачи, из-за которой падает воркер
+    cur.execute("ALTER TABLE jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP")
+    cur.execute("ALTER TABLE jobs ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0")
+
+    # Частичный индекс для выборки очереди воркером
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_queued
+        ON jobs (created_at) WHERE status = 'queued'
+    """)
+
+    # Частичный индекс для поиска задач с истёкшей арендой
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_running
+        ON jobs (heartbeat_at) WHERE status = 'running'
+    """)
+
+    # Версия схемы, которую проверяет приложение при запуске
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER NOT NULL
+        )
+    """)
+    cur.execute("DELETE FROM schema_version")
+    cur.execute("INSERT INTO schema_version (version) VALUES (%s)", (SCHEMA_VERSION,))
+
     conn.commit()
     cur.close()
     conn.close()
 
+def check_schema(conn):
+    # Проверка версии схемы без DDL: только чтение
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('schema_version')")
+    if cur.fetchone()[0] is None:
+        cur.close()
+        raise RuntimeError("Схема не создана: запустите python models.py")
+
+    cur.execute("SELECT MAX(version) FROM schema_version")
+    version = cur.fetchone()[0]
+    cur.close()
+    conn.rollback()
+
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(f"Версия схемы {version}, ожидается {SCHEMA_VERSION}: запустите python models.py")
+
 if __name__ == "__main__":
     create_tables()
     print("Таблицы созданы успешно")
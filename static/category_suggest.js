@@ -0,0 +1,18 @@
+// Подсказки категорий с сервера по мере ввода (страницы добавления и редактирования)
+(function () {
+    var categoryInput = document.getElementById('category');
+    var categoryList = document.getElementById('category-suggestions');
+    categoryInput.addEventListener('input', function () {
+        fetch('/categories/suggest?prefix=' + encodeURIComponent(categoryInput.value))
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                if (!data.suggestions || !data.suggestions.length) { return; }
+                categoryList.innerHTML = '';
+                data.suggestions.forEach(function (category) {
+                    var option = document.createElement('option');
+                    option.value = category;
+                    categoryList.appendChild(option);
+                });
+            });
+    });
+})();
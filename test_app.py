@@ -1,6 +1,8 @@
 import pytest
 from app import app
+from models import SCHEMA_VERSION
 import json
+import os
 import psycopg2
 
 # Конфигурация базы данных для тестов
@@ -19,9 +21,16 @@ def create_test_tables():
         cur = conn.cursor()
         
         # Очистка существующих таблиц
+        cur.execute("DROP TABLE IF EXISTS schema_version CASCADE")
+        cur.execute("DROP TABLE IF EXISTS expense_attachments CASCADE")
+        cur.execute("DROP TABLE IF EXISTS attachments CASCADE")
+        cur.execute("DROP TABLE IF EXISTS jobs CASCADE")
         cur.execute("DROP TABLE IF EXISTS audit_log CASCADE")
         cur.execute("DROP TABLE IF EXISTS expenses CASCADE")
         cur.execute("DROP TABLE IF EXISTS users CASCADE")
+        cur.execute("DROP TABLE IF EXISTS expense_tombstones CASCADE")
+        cur.execute("DROP TABLE IF EXISTS sync_horizon CASCADE")
+        cur.execute("DROP SEQUENCE IF EXISTS expense_change_seq")
         
         # Создание таблиц заново
         cur.execute("""
@@ -32,6 +41,7 @@ def create_test_tables():
             )
         """)
         
+        cur.execute("CREATE SEQUENCE expense_change_seq")
         cur.execute("""
             CREATE TABLE expenses (
                 id SERIAL PRIMARY KEY,
@@ -39,9 +49,48 @@ def create_test_tables():
                 amount DECIMAL(10,2) NOT NULL,
                 category VARCHAR(50) NOT NULL,
                 description TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                change_seq BIGINT NOT NULL DEFAULT nextval('expense_change_seq'),
+                fingerprint CHAR(64)
+            )
+        """)
+        cur.execute("CREATE INDEX idx_expenses_user_created ON expenses (user_id, created_at DESC)")
+        cur.execute("CREATE INDEX idx_expenses_user_change_seq ON expenses (user_id, change_seq)")
+        cur.execute("CREATE INDEX idx_expenses_user_fingerprint ON expenses (user_id, fingerprint, created_at)")
+
+        cur.execute("""
+            CREATE TABLE expense_tombstones (
+                expense_id INTEGER PRIMARY KEY,
+                user_id INTEGER REFERENCES users(id),
+                change_seq BIGINT NOT NULL,
+                deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cur.execute("CREATE INDEX idx_tombstones_user_change_seq ON expense_tombstones (user_id, change_seq)")
+
+        cur.execute("""
+            CREATE TABLE attachments (
+                sha256 CHAR(64) PRIMARY KEY,
+                size BIGINT NOT NULL,
+                content_type VARCHAR(100) NOT NULL,
+                ref_count INTEGER NOT NULL DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+
+        cur.execute("""
+            CREATE TABLE expense_attachments (
+                expense_id INTEGER REFERENCES expenses(id) ON DELETE CASCADE,
+                sha256 CHAR(64) REFERENCES attachments(sha256),
+                filename VARCHAR(255) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (expense_id, sha256)
+            )
+        """)
+
+        cur.execute("CREATE TABLE sync_horizon (purged_seq BIGINT NOT NULL)")
+        cur.execute("INSERT INTO sync_horizon (purged_seq) VALUES (0)")
         
         cur.execute("""
             CREATE TABLE audit_log (
@@ -52,7 +101,31 @@ def create_test_tables():
                 action_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        
+        cur.execute("CREATE INDEX idx_audit_log_user_time ON audit_log (user_id, action_time DESC)")
+
+        cur.execute("""
+            CREATE TABLE jobs (
+                id SERIAL PRIMARY KEY,
+                user_id INTEGER REFERENCES users(id),
+                kind VARCHAR(20) NOT NULL,
+                params TEXT,
+                status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                progress INTEGER NOT NULL DEFAULT 0,
+                result_path TEXT,
+                error TEXT,
+                cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                expires_at TIMESTAMP,
+                heartbeat_at TIMESTAMP,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+        cur.execute("CREATE TABLE schema_version (version INTEGER NOT NULL)")
+        cur.execute("INSERT INTO schema_version (version) VALUES (%s)", (SCHEMA_VERSION,))
+
         conn.commit()
         cur.close()
         conn.close()
@@ -290,6 +363,705 @@ def test_unauthorized_access(client):
         # Проверка того, что редирект ведет на страницу логина
         assert '/login' in response.location or 'login_page' in response.location
 
+# Тест фоновой выгрузки: постановка, выполнение и скачивание
+def test_export_job(client, tmp_path, monkeypatch):
+    import worker
+    monkeypatch.setattr(worker, 'JOBS_DIR', str(tmp_path))
+
+    client.post('/register', json={
+        'username': 'jobuser',
+        'password': 'jobpass'
+    })
+    client.post('/add', json={'amount': 100, 'category': 'Food'})
+
+    response = client.post('/jobs', json={'kind': 'export'})
+    assert response.status_code == 202
+    job_id = json.loads(response.data)['job_id']
+
+    # Выполняем задачу в текущем процессе вместо отдельного воркера
+    worker.run_job(job_id)
+
+    response = client.get(f'/jobs/{job_id}')
+    job = json.loads(response.data)['job']
+    assert job['status'] == 'done'
+    assert job['progress'] == 100
+
+    response = client.get(f'/jobs/{job_id}/download')
+    assert response.status_code == 200
+    assert b'Food' in response.data
+    print("Выгрузка выполнена фоновой задачей")
+
+# Тест отмены задачи в очереди
+def test_cancel_job(client):
+    client.post('/register', json={
+        'username': 'canceljobuser',
+        'password': 'cancelpass'
+    })
+
+    response = client.post('/jobs', json={'kind': 'report', 'params': {'year': 2024}})
+    job_id = json.loads(response.data)['job_id']
+
+    response = client.post(f'/jobs/{job_id}/cancel')
+    assert response.status_code == 200
+    assert json.loads(response.data)['status'] == 'cancelled'
+
+    # Результат отменённой задачи недоступен
+    response = client.get(f'/jobs/{job_id}/download')
+    assert response.status_code == 409
+    print("Задача отменена")
+
+# Тест восстановления задач, воркер которых умер
+def test_recover_stale_jobs(client):
+    import worker
+
+    user_id = json.loads(client.post('/register', json={
+        'username': 'staleuser',
+        'password': 'stalepass'
+    }).data)['user_id']
+
+    conn = psycopg2.connect(**TEST_DB_CONFIG)
+    cur = conn.cursor()
+    job_ids = {}
+    for name, attempts, heartbeat in (('retry', 1, '1 hour'), ('exhausted', worker.JOB_MAX_ATTEMPTS, '1 hour'),
+                                      ('alive', 1, '0 seconds')):
+        cur.execute("""
+            INSERT INTO jobs (user_id, kind, status, attempts, heartbeat_at)
+            VALUES (%s, 'export', 'running', %s, CURRENT_TIMESTAMP - %s::interval) RETURNING id
+        """, (user_id, attempts, heartbeat))
+        job_ids[name] = cur.fetchone()[0]
+    conn.commit()
+
+    worker.recover_stale_jobs()
+
+    statuses = {}
+    for name, job_id in job_ids.items():
+        statuses[name] = json.loads(client.get(f'/jobs/{job_id}').data)['job']['status']
+    assert statuses == {'retry': 'queued', 'exhausted': 'failed', 'alive': 'running'}
+
+    # Задача, которую нельзя выполнить, завершается, а не остаётся в running
+    cur.execute("""
+        INSERT INTO jobs (user_id, kind, status) VALUES (%s, 'unknown', 'running') RETURNING id
+    """, (user_id,))
+    job_id = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    worker.run_job(job_id)
+    job = json.loads(client.get(f'/jobs/{job_id}').data)['job']
+    assert job['status'] == 'failed'
+    assert 'unknown' in job['error']
+    print("Потерянные задачи возвращаются в очередь или завершаются")
+
+# Тест неизвестного типа задачи
+def test_submit_job_invalid(client):
+    client.post('/register', json={
+        'username': 'badjobuser',
+        'password': 'badjobpass'
+    })
+
+    response = client.post('/jobs', json={'kind': 'unknown'})
+    assert response.status_code == 400
+
+    # Тело или params не объект: 400, а не ошибка сервера
+    for body in ([{'kind': 'report'}], 'report', {'kind': 'report', 'params': [2024]},
+                 {'kind': 'report', 'params': 2024}):
+        response = client.post('/jobs', json=body)
+        assert response.status_code == 400
+    print("Неизвестный тип задачи отклонен")
+
+# Тест liveness-проверки
+def test_healthz(client):
+    response = client.get('/healthz')
+
+    assert response.status_code == 200
+    assert json.loads(response.data)['status'] == 'ok'
+    print("Liveness-проверка отвечает")
+
+# Тест readiness-проверки до и после прогрева
+def test_readyz(client):
+    from app import warm_up
+
+    app.config['READY'] = False
+    response = client.get('/readyz')
+    assert response.status_code == 503
+
+    warm_up()
+
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    assert json.loads(response.data)['status'] == 'ready'
+    print("Приложение готово после прогрева")
+
+# Тест старта воркера при недоступной БД: воркер не падает, а прогревается в фоне
+def test_worker_warm_up_retry(client, monkeypatch):
+    import threading
+    import time
+    import app as app_module
+
+    attempts = []
+    db_back = threading.Event()
+
+    def flaky_warm_up():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise psycopg2.OperationalError("connection refused")
+        db_back.wait(5)
+        app.config['READY'] = True
+
+    monkeypatch.setattr(app_module, 'warm_up', flaky_warm_up)
+    monkeypatch.setattr(app_module, 'WARM_UP_RETRY_INTERVAL', 0.01)
+    monkeypatch.setattr(app_module, 'db_pool', app_module.db_pool)
+
+    app_module.init_worker()
+    assert client.get('/readyz').status_code == 503
+
+    db_back.set()
+    deadline = time.monotonic() + 5
+    while not app.config['READY'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert client.get('/readyz').status_code == 200
+    print("Воркер дождался БД и стал готов")
+
+# Тест возврата соединения в пул, когда маршрут падает с ошибкой БД
+def test_pool_connection_returned_on_error(client, monkeypatch):
+    import app as app_module
+    small_pool = app_module.BlockingConnectionPool(1, 2, 1, **TEST_DB_CONFIG)
+    monkeypatch.setattr(app_module, 'db_pool', small_pool)
+
+    client.post('/register', json={
+        'username': 'pooluser',
+        'password': 'poolpass'
+    })
+
+    # Категория длиннее VARCHAR(50): INSERT падает с DataError
+    for _ in range(3):
+        with pytest.raises(psycopg2.DataError):
+            client.post('/add', json={'amount': 10, 'category': 'x' * 60})
+
+    response = client.post('/add', json={'amount': 10, 'category': 'Еда'})
+    assert response.status_code == 201
+    small_pool.closeall()
+    print("Соединения возвращаются в пул после ошибок")
+
+# Тест инкрементальной синхронизации с удалениями
+def test_sync(client):
+    client.post('/register', json={
+        'username': 'syncuser',
+        'password': 'syncpass'
+    })
+
+    kept_id = json.loads(client.post('/add', json={'amount': 100, 'category': 'Food'}).data)['expense_id']
+    removed_id = json.loads(client.post('/add', json={'amount': 200, 'category': 'Taxi'}).data)['expense_id']
+
+    # Первая синхронизация возвращает всё
+    data = json.loads(client.get('/sync').data)
+    assert len(data['upserts']) == 2
+    token = data['token']
+
+    client.post(f'/edit/{kept_id}', json={'amount': 150})
+    client.post(f'/delete/{removed_id}')
+
+    # Повторная синхронизация возвращает только изменения после токена
+    data = json.loads(client.get(f'/sync?since={token}').data)
+    assert [e['id'] for e in data['upserts']] == [kept_id]
+    assert data['deleted'] == [removed_id]
+    assert data['token'] > token
+
+    # Без новых изменений ответ пустой, токен прежний
+    new_token = data['token']
+    data = json.loads(client.get(f'/sync?since={new_token}').data)
+    assert data['upserts'] == [] and data['deleted'] == []
+    assert data['token'] == new_token
+    print("Синхронизация вернула только изменения")
+
+# Тест синхронизации при параллельной незакоммиченной транзакции
+def test_sync_waits_for_inflight_change(client):
+    import threading
+    from app import SYNC_LOCK_SPACE
+
+    user_id = json.loads(client.post('/register', json={
+        'username': 'inflightuser',
+        'password': 'inflightpass'
+    }).data)['user_id']
+    expense_id = json.loads(client.post('/add', json={'amount': 10, 'category': 'Еда'}).data)['expense_id']
+    token = json.loads(client.get('/sync?since=0').data)['token']
+
+    # Транзакция A получила номер изменения, но ещё не закоммичена
+    conn = psycopg2.connect(**TEST_DB_CONFIG)
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (SYNC_LOCK_SPACE, user_id))
+    cur.execute("""
+        UPDATE expenses SET amount = 20, change_seq = nextval('expense_change_seq')
+        WHERE id = %s RETURNING change_seq
+    """, (expense_id,))
+    inflight_seq = cur.fetchone()[0]
+
+    # Тем временем другая транзакция коммитит номер больше
+    other = psycopg2.connect(**TEST_DB_CONFIG)
+    other_cur = other.cursor()
+    other_cur.execute("SELECT nextval('expense_change_seq')")
+    other.commit()
+    other.close()
+
+    # Отдельный клиент: клиент фикстуры держит контекст приложения своего потока
+    sync_client = app.test_client()
+    sync_client.post('/login', json={'username': 'inflightuser', 'password': 'inflightpass'})
+    result = {}
+    sync = threading.Thread(target=lambda: result.update(
+        response=sync_client.get(f'/sync?since={token}')))
+    sync.start()
+    sync.join(0.5)
+    assert sync.is_alive()
+
+    conn.commit()
+    conn.close()
+    sync.join(5)
+
+    data = json.loads(result['response'].data)
+    assert [row['id'] for row in data['upserts']] == [expense_id]
+    assert data['token'] >= inflight_seq
+    print("Токен синхронизации не обгоняет незакоммиченное изменение")
+
+# Тест токена страницы списка после компактации надгробий
+def test_list_page_token_above_horizon(client):
+    import re
+
+    client.post('/register', json={
+        'username': 'horizonpageuser',
+        'password': 'horizonpass'
+    })
+    client.post('/add', json={'amount': 10, 'category': 'Еда'})
+
+    # Компактация сдвинула горизонт выше всех изменений пользователя
+    conn = psycopg2.connect(**TEST_DB_CONFIG)
+    cur = conn.cursor()
+    cur.execute("UPDATE sync_horizon SET purged_seq = nextval('expense_change_seq')")
+    conn.commit()
+    try:
+        page = client.get('/list_page').data.decode('utf-8')
+        token = int(re.search(r'var syncToken = (\d+);', page).group(1))
+
+        # Страница не уходит в бесконечную перезагрузку через reset
+        data = json.loads(client.get(f'/sync?since={token}').data)
+        assert data['reset'] is False
+        assert data['upserts'] == [] and data['deleted'] == []
+    finally:
+        cur.execute("UPDATE sync_horizon SET purged_seq = 0")
+        conn.commit()
+        cur.close()
+        conn.close()
+    print("Токен страницы не ниже горизонта компактации")
+
+# Тест синхронизации клиента с токеном старше горизонта
+def test_sync_reset_token_above_horizon(client):
+    client.post('/register', json={
+        'username': 'horizonsyncuser',
+        'password': 'horizonpass'
+    })
+    expense_id = json.loads(client.post('/add', json={'amount': 10, 'category': 'Еда'}).data)['expense_id']
+    token = json.loads(client.get('/sync?since=0').data)['token']
+
+    conn = psycopg2.connect(**TEST_DB_CONFIG)
+    cur = conn.cursor()
+    cur.execute("UPDATE sync_horizon SET purged_seq = nextval('expense_change_seq') RETURNING purged_seq")
+    purged_seq = cur.fetchone()[0]
+    conn.commit()
+    try:
+        # Токен старше горизонта: полный список и токен не ниже горизонта
+        data = json.loads(client.get(f'/sync?since={token}').data)
+        assert data['reset'] is True
+        assert [e['id'] for e in data['upserts']] == [expense_id]
+        assert data['token'] >= purged_seq
+
+        # Следующая синхронизация снова инкрементальная
+        data = json.loads(client.get(f"/sync?since={data['token']}").data)
+        assert data['reset'] is False
+        assert data['upserts'] == [] and data['deleted'] == []
+    finally:
+        cur.execute("UPDATE sync_horizon SET purged_seq = 0")
+        conn.commit()
+        cur.close()
+        conn.close()
+    print("После сброса синхронизация снова инкрементальная")
+
+# Тест вложений: загрузка, дедупликация, частичное скачивание и очистка при удалении
+def test_attachments(client, tmp_path, monkeypatch):
+    import app as app_module
+    monkeypatch.setattr(app_module, 'ATTACHMENTS_DIR', str(tmp_path))
+
+    client.post('/register', json={
+        'username': 'attachuser',
+        'password': 'attachpass'
+    })
+    first_id = json.loads(client.post('/add', json={'amount': 100, 'category': 'Food'}).data)['expense_id']
+    second_id = json.loads(client.post('/add', json={'amount': 200, 'category': 'Food'}).data)['expense_id']
+
+    content = b'\x89PNG receipt ' * 1000
+    for expense_id in (first_id, second_id):
+        response = client.post(f'/expenses/{expense_id}/attachments', data=content,
+                               content_type='image/png', headers={'X-Filename': 'receipt.png'})
+        assert response.status_code == 201
+    sha256 = json.loads(response.data)['sha256']
+
+    # Одинаковый файл хранится один раз
+    path = app_module.attachment_path(sha256)
+    assert os.listdir(os.path.dirname(path)) == [sha256]
+
+    response = client.get(f'/expenses/{first_id}/attachments')
+    assert json.loads(response.data)['attachments'][0]['filename'] == 'receipt.png'
+
+    response = client.get(f'/expenses/{first_id}/attachments/{sha256}', headers={'Range': 'bytes=0-9'})
+    assert response.status_code == 206
+    assert response.data == content[:10]
+
+    # Общие кеши не должны хранить чеки пользователя
+    cache_control = response.headers['Cache-Control']
+    assert 'private' in cache_control and 'public' not in cache_control
+
+    response = client.get(f'/expenses/{first_id}/attachments/{sha256}', headers={'If-None-Match': f'"{sha256}"'})
+    assert response.status_code == 304
+
+    # Файл удаляется вместе с последней ссылкой на него
+    client.post(f'/delete/{first_id}')
+    assert os.path.exists(path)
+    client.post(f'/delete/{second_id}')
+    assert not os.path.exists(path)
+    print("Вложения сохраняются по хешу и очищаются при удалении")
+
+# Тест отката удаления: файл вложения остаётся вместе с восстановленной строкой
+def test_attachment_kept_on_rollback(client, tmp_path, monkeypatch):
+    import app as app_module
+    monkeypatch.setattr(app_module, 'ATTACHMENTS_DIR', str(tmp_path))
+
+    client.post('/register', json={
+        'username': 'rollbackuser',
+        'password': 'rollbackpass'
+    })
+    expense_id = json.loads(client.post('/add', json={'amount': 100, 'category': 'Food'}).data)['expense_id']
+    response = client.post(f'/expenses/{expense_id}/attachments', data=b'%PDF-1.4 rollback',
+                           content_type='application/pdf')
+    sha256 = json.loads(response.data)['sha256']
+
+    def failing_notify(*args):
+        raise psycopg2.OperationalError("connection lost")
+
+    # Транзакция удаления падает после отвязки вложения и откатывается
+    monkeypatch.setattr(app_module, 'notify_change', failing_notify)
+    with pytest.raises(psycopg2.OperationalError):
+        client.post(f'/delete/{expense_id}')
+
+    assert os.path.exists(app_module.attachment_path(sha256))
+    response = client.get(f'/expenses/{expense_id}/attachments/{sha256}')
+    assert response.status_code == 200
+    assert response.data == b'%PDF-1.4 rollback'
+    print("Откат удаления не теряет файл вложения")
+
+# Тест отклонения неподдерживаемого типа вложения
+def test_attachment_invalid_type(client):
+    client.post('/register', json={
+        'username': 'attachtypeuser',
+        'password': 'attachpass'
+    })
+    expense_id = json.loads(client.post('/add', json={'amount': 100, 'category': 'Food'}).data)['expense_id']
+
+    response = client.post(f'/expenses/{expense_id}/attachments', data=b'#!/bin/sh',
+                           content_type='text/x-shellscript')
+    assert response.status_code == 415
+    print("Неподдерживаемый тип вложения отклонен")
+
+# Тест подсказок категорий: ранжирование по частоте и обновление при изменениях
+def test_category_suggestions(client, monkeypatch):
+    import app as app_module
+    loads = []
+
+    def loader(user_id):
+        loads.append(user_id)
+        return app_module.load_user_categories(user_id)
+
+    # Без слушателя: (пере)подключение сбросило бы индекс в случайный момент
+    monkeypatch.setattr(app_module.change_feed, '_ensure_listener', lambda: None)
+    monkeypatch.setattr(app_module.category_index, 'loader', loader)
+
+    client.post('/register', json={
+        'username': 'categoryuser',
+        'password': 'categorypass'
+    })
+
+    taxi_id = json.loads(client.post('/add', json={'amount': 100, 'category': 'Такси'}).data)['expense_id']
+    client.post('/add', json={'amount': 200, 'category': 'Транспорт'})
+    client.post('/add', json={'amount': 300, 'category': 'Транспорт'})
+
+    response = client.get('/categories/suggest?prefix=т')
+    assert response.status_code == 200
+    assert json.loads(response.data)['suggestions'] == ['Транспорт', 'Такси']
+    assert len(loads) == 1
+
+    # Индекс уже загружен: новая категория появляется без обращения к БД.
+    # Собственное уведомление процесса индекс не сбрасывает
+    add_response = client.post('/add', json={'amount': 50, 'category': 'Театр'})
+    expense_id = json.loads(add_response.data)['expense_id']
+    app_module.change_feed.dispatch(json.dumps({
+        'user_id': loads[0], 'action': 'add', 'expense_id': expense_id,
+        'origin': app_module.change_feed.origin
+    }))
+    assert 'Театр' in json.loads(client.get('/categories/suggest?prefix=те').data)['suggestions']
+
+    client.post(f'/delete/{expense_id}')
+    assert json.loads(client.get('/categories/suggest?prefix=те').data)['suggestions'] == []
+    assert len(loads) == 1
+
+    # Скрипт подсказок общий для страниц добавления и редактирования
+    script = "/static/category_suggest.js"
+    assert script in client.get('/add_page').data.decode('utf-8')
+    assert script in client.get(f'/edit_page/{taxi_id}').data.decode('utf-8')
+    assert client.get(script).status_code == 200
+    print("Подсказки категорий работают")
+
+# Тест пометки повторно добавленного расхода
+def test_duplicate_expense_flagged(client):
+    client.post('/register', json={
+        'username': 'dupuser',
+        'password': 'duppass'
+    })
+
+    first = json.loads(client.post('/add', json={
+        'amount': 250, 'category': 'Кафе', 'description': 'Обед'
+    }).data)
+    assert 'duplicate_of' not in first
+
+    # Регистр и лишние пробелы не влияют на отпечаток
+    second = json.loads(client.post('/add', json={
+        'amount': '250.00', 'category': ' кафе ', 'description': 'обед'
+    }).data)
+    assert second['duplicate_of'] == first['expense_id']
+
+    other = json.loads(client.post('/add', json={
+        'amount': 251, 'category': 'Кафе', 'description': 'Обед'
+    }).data)
+    assert 'duplicate_of' not in other
+
+    response = client.get('/duplicates')
+    assert response.status_code == 200
+    groups = json.loads(response.data)['duplicates']
+    assert len(groups) == 1
+    assert groups[0]['expense_ids'] == [first['expense_id'], second['expense_id']]
+    print("Дубликаты помечаются и попадают в отчёт")
+
+# Тест отклонения дубликата
+def test_duplicate_expense_rejected(client, monkeypatch):
+    import app as app_module
+    monkeypatch.setattr(app_module, 'DUPLICATE_POLICY', 'reject')
+
+    client.post('/register', json={
+        'username': 'rejectuser',
+        'password': 'rejectpass'
+    })
+
+    first = json.loads(client.post('/add', json={'amount': 99, 'category': 'Такси'}).data)
+    response = client.post('/add', json={'amount': 99, 'category': 'Такси'})
+    assert response.status_code == 409
+    assert json.loads(response.data)['duplicate_of'] == first['expense_id']
+
+    # Пользователь подтвердил, что это отдельный расход
+    response = client.post('/add', json={'amount': 99, 'category': 'Такси', 'allow_duplicate': True})
+    assert response.status_code == 201
+
+    # HTML-форма возвращается с введёнными значениями и флажком подтверждения
+    form = {'amount': '99', 'category': ' такси ', 'description': 'До вокзала'}
+    client.post('/add', data=form)
+    response = client.post('/add', data=form)
+    assert response.status_code == 200
+    page = response.data.decode('utf-8')
+    assert 'Такой расход уже добавлен недавно' in page
+    assert 'value="99"' in page
+    assert 'До вокзала</textarea>' in page
+    assert 'name="allow_duplicate"' in page
+
+    response = client.post('/add', data=dict(form, allow_duplicate='1'))
+    assert response.status_code == 302
+    print("Дубликат отклонён, подтверждённый расход добавлен")
+
+# Тест проверки политики дубликатов при запуске
+def test_duplicate_policy_validated():
+    import subprocess
+    import sys
+    from categories import normalize_category
+    from models import expense_fingerprint
+
+    result = subprocess.run([sys.executable, '-c', 'import app'], capture_output=True, text=True,
+                            env=dict(os.environ, DUPLICATE_POLICY='rejct'),
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode != 0
+    assert 'DUPLICATE_POLICY' in result.stderr
+
+    # Индекс категорий и отпечаток дубликатов нормализуют одинаково
+    assert normalize_category('  Кафе   у  дома ') == normalize_category('кафе у дома')
+    assert (expense_fingerprint(1, 10, '  Кафе   у  дома ', '') ==
+            expense_fingerprint(1, 10, 'кафе у дома', ''))
+    print("Неизвестная политика дубликатов останавливает запуск")
+
+# Тест вытеснения пользователей из индекса категорий
+def test_category_index_lru():
+    from categories import CategoryIndex
+    loads = []
+
+    def loader(user_id):
+        loads.append(user_id)
+        return [('Еда', 1)]
+
+    index = CategoryIndex(loader, max_users=2)
+    index.suggest(1, '')
+    index.suggest(2, '')
+    index.suggest(1, '')
+    index.suggest(3, '')  # вытесняет пользователя 2, к которому обращались давнее всего
+    index.suggest(1, '')
+    index.suggest(2, '')
+
+    assert loads == [1, 2, 3, 2]
+    print("Индекс категорий ограничен LRU")
+
+# Тест сброса индекса категорий: изменения других процессов, гонка с загрузкой и TTL
+def test_category_index_invalidation():
+    import time
+    from categories import CategoryIndex
+    from events import ChangeFeed
+    loads = []
+    rows = [('Еда', 1)]
+
+    def loader(user_id):
+        loads.append(user_id)
+        return list(rows)
+
+    index = CategoryIndex(loader)
+    feed = ChangeFeed(TEST_DB_CONFIG)
+    feed.add_callback(index.invalidate)
+
+    index.suggest(1, '')
+    index.suggest(2, '')
+    # Другой процесс добавил расход: уведомление сбрасывает только этого пользователя
+    rows.append(('Кафе', 1))
+    feed.dispatch(json.dumps({'user_id': 1, 'action': 'add', 'expense_id': 7}))
+    assert index.suggest(1, 'к') == ['Кафе']
+    index.suggest(2, '')
+    assert loads == [1, 2, 1]
+
+    # Своё уведомление не сбрасывает индекс: процесс уже применил изменение
+    feed.dispatch(json.dumps({'user_id': 1, 'action': 'add', 'expense_id': 8, 'origin': feed.origin}))
+    index.suggest(1, '')
+    assert loads == [1, 2, 1]
+
+    # Переподключение слушателя: уведомления могли потеряться, сбрасываются все
+    index.invalidate(None)
+    index.suggest(2, '')
+    assert loads == [1, 2, 1, 2]
+
+    # Изменение, закоммиченное во время загрузки, не теряется в кеше
+    def racing_loader(user_id):
+        loads.append(user_id)
+        snapshot = list(rows)
+        index.add(user_id, 'Театр')
+        return snapshot
+
+    index.loader = racing_loader
+    index.suggest(3, '')
+    index.loader = loader
+    rows.append(('Театр', 1))
+    assert index.suggest(3, 'т') == ['Театр']
+    assert loads[-2:] == [3, 3]
+
+    # TTL ограничивает устаревание, если уведомление потеряно совсем
+    index = CategoryIndex(loader, ttl=0.01)
+    index.suggest(1, '')
+    time.sleep(0.02)
+    index.suggest(1, '')
+    assert loads[-2:] == [1, 1]
+    print("Индекс категорий сбрасывается при внешних изменениях")
+
+# Тест раздачи уведомлений только подписчикам своего пользователя
+def test_change_feed_dispatch():
+    from events import ChangeFeed
+    feed = ChangeFeed(TEST_DB_CONFIG, buffer_size=10)
+    feed._ensure_listener = lambda: None
+
+    own = feed.subscribe(1)
+    other = feed.subscribe(2)
+    feed.dispatch(json.dumps({'user_id': 1, 'action': 'add', 'expense_id': 5}))
+
+    assert json.loads(own.queue.get_nowait())['expense_id'] == 5
+    assert other.queue.empty()
+    print("Уведомление доставлено только владельцу")
+
+# Тест отключения медленного подписчика при переполнении буфера
+def test_change_feed_slow_subscriber():
+    from events import ChangeFeed
+    feed = ChangeFeed(TEST_DB_CONFIG, buffer_size=2)
+    feed._ensure_listener = lambda: None
+
+    subscriber = feed.subscribe(1)
+    for expense_id in range(3):
+        feed.dispatch(json.dumps({'user_id': 1, 'action': 'add', 'expense_id': expense_id}))
+
+    assert subscriber.overflowed
+    assert subscriber.queue.qsize() == 2
+    assert 1 not in feed._subscribers
+    print("Медленный подписчик отключен")
+
+# Тест лимита открытых потоков изменений на процесс
+def test_change_feed_stream_limit(client, monkeypatch):
+    import app as app_module
+    from events import ChangeFeed
+    feed = ChangeFeed(TEST_DB_CONFIG, buffer_size=10, max_subscribers=1)
+    feed._ensure_listener = lambda: None
+
+    first = feed.subscribe(1)
+    assert feed.subscribe(2) is None
+    feed.unsubscribe(first)
+    feed.unsubscribe(first)
+    assert feed.subscribe(2) is not None
+
+    # Сверх лимита /events отвечает 503, и страница переходит на опрос /sync
+    client.post('/register', json={
+        'username': 'streamuser',
+        'password': 'streampass'
+    })
+    monkeypatch.setattr(app_module, 'change_feed', feed)
+    response = client.get('/events')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '30'
+    print("Лимит SSE-потоков соблюдается")
+
+# Тест завершения SSE-потоков при остановке воркера
+def test_change_feed_stop(client, monkeypatch):
+    import threading
+    import app as app_module
+    from events import ChangeFeed
+    feed = ChangeFeed(TEST_DB_CONFIG, buffer_size=10)
+    feed._ensure_listener = lambda: None
+    monkeypatch.setattr(app_module, 'change_feed', feed)
+
+    client.post('/register', json={
+        'username': 'stopstreamuser',
+        'password': 'stopstreampass'
+    })
+    response = client.get('/events', buffered=False)
+    assert response.status_code == 200
+    chunks = []
+    reader = threading.Thread(target=lambda: chunks.extend(response.response))
+    reader.start()
+    reader.join(0.3)
+    assert reader.is_alive()
+
+    # Поток, ждущий уведомлений, завершается сразу, а не по таймауту heartbeat
+    feed.stop()
+    reader.join(2)
+    assert not reader.is_alive()
+    assert chunks[-1] == f"retry: {app_module.SSE_RECONNECT_DELAY}\n\n".encode()
+
+    # Новые потоки останавливающийся воркер не принимает
+    assert client.get('/events').status_code == 503
+    print("SSE-потоки завершаются при остановке воркера")
+
 if __name__ == '__main__':
     # Для запуска тестов напрямую
     pytest.main([__file__, '-v'])
@@ -0,0 +1,251 @@
+import pytest
+import app as app_module
+import worker
+from app import app
+from test_app import create_test_tables, TEST_DB_CONFIG
+import json
+import psycopg2
+
+# Объём тестовых данных: пользователи и записи на пользователя
+SEED_USERS = 500
+SEED_ROWS_PER_USER = 200
+
+# Последовательное сканирование допустимо только для маленьких таблиц
+SEQ_SCAN_ROW_THRESHOLD = 1000
+# Бюджет оценочной стоимости одного запроса (seq scan по expenses стоит в разы больше)
+COST_BUDGET = 1000
+
+# Максимальное число SQL-запросов на один HTTP-запрос
+QUERY_BUDGETS = {
+    'register': 2,
+    'login': 2,
+    'add_expense': 7,
+    'list_expenses': 3,
+    'list_page': 5,
+    'edit_expense': 6,
+    'edit_page': 2,
+    'update_expense': 6,
+    'delete_expense': 9,
+    'delete_html': 9,
+    'upload_attachment': 6,
+    'list_attachments': 2,
+    'download_attachment': 2,
+    'get_audit': 2,
+    'suggest_categories': 2,
+    'sync_expenses': 5,
+    'duplicates_report': 2,
+    'submit_job': 3,
+    'job_status': 2,
+    'cancel_job': 3,
+    'download_job': 2,
+    'logout': 2,
+}
+
+# Сканы, использующие индекс
+INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan', 'Bitmap Heap Scan')
+
+
+class RecordingCursor:
+    # Курсор, записывающий каждый выполненный запрос
+    def __init__(self, cursor, log):
+        self._cursor = cursor
+        self._log = log
+
+    def execute(self, query, params=None):
+        self._log.append((query, params))
+        return self._cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class RecordingConnection:
+    def __init__(self, conn, log):
+        self._conn = conn
+        self._log = log
+
+    def cursor(self, *args, **kwargs):
+        return RecordingCursor(self._conn.cursor(*args, **kwargs), self._log)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def seed_database():
+    # Большой набор данных, чтобы планировщик выбирал планы как в продакшене
+    conn = psycopg2.connect(**TEST_DB_CONFIG)
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO users (username, password)
+        SELECT 'seed_' || g, 'x' FROM generate_series(1, %s) g
+    """, (SEED_USERS,))
+    cur.execute("""
+        INSERT INTO expenses (user_id, amount, category, description, created_at)
+        SELECT u.id, 1 + n %% 1000, (ARRAY['Еда', 'Транспорт', 'Жилье', 'Другое'])[1 + n %% 4],
+               'seed', CURRENT_TIMESTAMP - n * INTERVAL '1 hour'
+        FROM users u CROSS JOIN generate_series(1, %s) n
+        WHERE u.username LIKE 'seed_%%'
+        ORDER BY u.id, n
+    """, (SEED_ROWS_PER_USER,))
+    cur.execute("""
+        INSERT INTO audit_log (user_id, action_type, action_time)
+        SELECT u.id, 'view_list', CURRENT_TIMESTAMP - n * INTERVAL '1 minute'
+        FROM users u CROSS JOIN generate_series(1, %s) n
+        WHERE u.username LIKE 'seed_%%'
+        ORDER BY u.id, n
+    """, (SEED_ROWS_PER_USER,))
+    conn.commit()
+
+    conn.autocommit = True
+    cur.execute("ANALYZE")
+    cur.close()
+    conn.close()
+
+
+def run(client, log, method, url, **kwargs):
+    # Выполняет HTTP-запрос и возвращает SQL-запросы, которые он выдал
+    del log[:]
+    response = getattr(client, method)(url, **kwargs)
+    return response, list(log)
+
+
+@pytest.fixture(scope="module")
+def captured(tmp_path_factory):
+    # Проходим по всем маршрутам и собираем выполненные ими запросы
+    if not create_test_tables():
+        pytest.exit("Не удалось создать тестовые таблицы")
+    seed_database()
+
+    log = []
+    original = app_module.get_db_connection
+    monkeypatch = pytest.MonkeyPatch()
+    monkeypatch.setattr(app_module, 'get_db_connection', lambda: RecordingConnection(original(), log))
+    monkeypatch.setattr(app_module, 'ATTACHMENTS_DIR', str(tmp_path_factory.mktemp('attachments')))
+    monkeypatch.setattr(worker, 'JOBS_DIR', str(tmp_path_factory.mktemp('job_results')))
+
+    app.config['TESTING'] = True
+    statements = {}
+    with app.test_client() as client:
+        def call(endpoint, method, url, **kwargs):
+            response, queries = run(client, log, method, url, **kwargs)
+            assert response.status_code < 500, f"{endpoint}: {response.status_code}"
+            statements[endpoint] = queries
+            return response
+
+        call('register', 'post', '/register', json={'username': 'planuser', 'password': 'planpass'})
+        call('login', 'post', '/login', json={'username': 'planuser', 'password': 'planpass'})
+        response = call('add_expense', 'post', '/add', json={'amount': 100, 'category': 'Food'})
+        expense_id = json.loads(response.data)['expense_id']
+        call('list_expenses', 'get', '/list')
+        call('list_page', 'get', '/list_page')
+        call('edit_expense', 'post', f'/edit/{expense_id}', json={'amount': 120})
+        call('edit_page', 'get', f'/edit_page/{expense_id}')
+        call('update_expense', 'post', f'/update_expense/{expense_id}',
+             data={'amount': '130', 'category': 'Food', 'description': ''})
+        response = call('upload_attachment', 'post', f'/expenses/{expense_id}/attachments',
+                        data=b'%PDF-1.4 receipt', content_type='application/pdf')
+        sha256 = json.loads(response.data)['sha256']
+        call('list_attachments', 'get', f'/expenses/{expense_id}/attachments')
+        call('download_attachment', 'get', f'/expenses/{expense_id}/attachments/{sha256}')
+        call('get_audit', 'get', '/audit')
+        call('suggest_categories', 'get', '/categories/suggest?prefix=F')
+        call('sync_expenses', 'get', '/sync?since=0')
+        call('duplicates_report', 'get', '/duplicates')
+        response = call('submit_job', 'post', '/jobs', json={'kind': 'export'})
+        job_id = json.loads(response.data)['job_id']
+        call('job_status', 'get', f'/jobs/{job_id}')
+        call('cancel_job', 'post', f'/jobs/{job_id}/cancel')
+        # Готовый результат: задача выполняется в текущем процессе, её запросы не записываются
+        job_id = json.loads(client.post('/jobs', json={'kind': 'export'}).data)['job_id']
+        worker.run_job(job_id)
+        response = call('download_job', 'get', f'/jobs/{job_id}/download')
+        assert response.status_code == 200
+        call('delete_expense', 'post', f'/delete/{expense_id}')
+        response = client.post('/add', json={'amount': 50, 'category': 'Food'})
+        call('delete_html', 'post', f"/delete_html/{json.loads(response.data)['expense_id']}")
+        call('logout', 'get', '/logout')
+
+    monkeypatch.undo()
+    yield statements
+
+
+def explain(cur, query, params):
+    # EXPLAIN без ANALYZE не выполняет запрос, поэтому безопасен и для INSERT/UPDATE/DELETE
+    cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+    return cur.fetchone()[0][0]['Plan']
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def table_rows(cur):
+    cur.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")
+    return dict(cur.fetchall())
+
+
+@pytest.fixture(scope="module")
+def plans(captured):
+    conn = psycopg2.connect(**TEST_DB_CONFIG)
+    cur = conn.cursor()
+    result = []
+    for endpoint, queries in captured.items():
+        for query, params in queries:
+            result.append((endpoint, query, explain(cur, query, params)))
+    rows = table_rows(cur)
+    conn.rollback()
+    cur.close()
+    conn.close()
+    yield result, rows
+
+
+# Тест бюджета запросов на каждый маршрут
+def test_query_budgets(captured):
+    assert set(captured) == set(QUERY_BUDGETS)
+    for endpoint, queries in captured.items():
+        assert len(queries) <= QUERY_BUDGETS[endpoint], \
+            f"{endpoint}: {len(queries)} запросов, бюджет {QUERY_BUDGETS[endpoint]}"
+    print("Все маршруты укладываются в бюджет запросов")
+
+
+# Тест поиска расходов по индексу (списки и проверка владельца)
+def test_expense_lookups_use_index(plans):
+    result, _ = plans
+    checked = 0
+    for endpoint, query, plan in result:
+        scans = [node for node in plan_nodes(plan) if node.get('Relation Name') == 'expenses'
+                 and node['Node Type'] != 'ModifyTable']
+        if not scans:
+            continue
+        checked += 1
+        assert all(node['Node Type'] in INDEX_SCANS for node in scans), \
+            f"{endpoint}: поиск по expenses без индекса\n{query}"
+    assert checked > 0
+    print(f"Проверено запросов к expenses: {checked}")
+
+
+# Тест отсутствия seq scan по большим таблицам и бюджета стоимости
+def test_no_seq_scans_and_cost_budget(plans):
+    result, rows = plans
+    for endpoint, query, plan in result:
+        for node in plan_nodes(plan):
+            if node['Node Type'] == 'Seq Scan':
+                relation = node['Relation Name']
+                assert rows.get(relation, 0) <= SEQ_SCAN_ROW_THRESHOLD, \
+                    f"{endpoint}: seq scan по {relation} ({rows[relation]:.0f} строк)\n{query}"
+        assert plan['Total Cost'] <= COST_BUDGET, \
+            f"{endpoint}: стоимость {plan['Total Cost']} больше {COST_BUDGET}\n{query}"
+    print(f"Проверено планов: {len(result)}")
+
+
+if __name__ == '__main__':
+    # Для запуска тестов напрямую
+    pytest.main([__file__, '-v'])
@@ -0,0 +1,350 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from app import DB_CONFIG, JOBS_DIR, remove_orphaned_attachments
+
+# Настройки воркера
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '2'))
+RESULT_TTL_HOURS = int(os.environ.get('JOB_RESULT_TTL_HOURS', '24'))
+TOMBSTONE_TTL_DAYS = int(os.environ.get('TOMBSTONE_TTL_DAYS', '30'))
+EXPIRE_INTERVAL = 60
+EXPORT_BATCH_SIZE = 1000
+# Аренда задачи: без heartbeat дольше JOB_LEASE_SECONDS задача считается потерянной
+# и возвращается в очередь, пока не исчерпаны попытки
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '60'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def get_db_connection():
+    return psycopg2.connect(**DB_CONFIG)
+
+
+def claim_job():
+    # Забираем самую старую задачу из очереди; SKIP LOCKED позволяет
+    # нескольким воркерам работать параллельно, не блокируя друг друга
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id FROM jobs
+        WHERE status = 'queued'
+        ORDER BY created_at
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    """)
+    row = cur.fetchone()
+    job_id = None
+    if row:
+        job_id = row[0]
+        cur.execute("""
+            UPDATE jobs
+            SET status = 'running', started_at = CURRENT_TIMESTAMP,
+                heartbeat_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+            WHERE id = %s
+        """, (job_id,))
+    conn.commit()
+    cur.close()
+    conn.close()
+    return job_id
+
+
+def set_progress(conn, job_id, progress):
+    # Обновляет прогресс и заодно проверяет, не запрошена ли отмена
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE jobs SET progress = %s WHERE id = %s
+        RETURNING cancel_requested
+    """, (progress, job_id))
+    cancel_requested = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    if cancel_requested:
+        raise JobCancelled()
+
+
+def export_expenses(conn, job_id, user_id, params, path):
+    # Полная выгрузка истории в CSV через серверный курсор, без загрузки всех строк в память
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM expenses WHERE user_id = %s", (user_id,))
+    total = cur.fetchone()[0]
+    cur.close()
+
+    cur = conn.cursor(name=f"export_job_{job_id}")
+    cur.itersize = EXPORT_BATCH_SIZE
+    cur.execute("""
+        SELECT id, created_at, category, description, amount
+        FROM expenses
+        WHERE user_id = %s
+        ORDER BY created_at
+    """, (user_id,))
+
+    # Во время выгрузки нельзя делать commit (закроется серверный курсор),
+    # поэтому прогресс и флаг отмены пишем через одно отдельное соединение на задачу
+    progress_conn = get_db_connection()
+    done = 0
+    try:
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['id', 'created_at', 'category', 'description', 'amount'])
+            while True:
+                rows = cur.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                done += len(rows)
+                set_progress(progress_conn, job_id, done * 100 // max(total, 1))
+    finally:
+        progress_conn.close()
+    cur.close()
+
+
+def yearly_report(conn, job_id, user_id, params, path):
+    # Годовой отчёт: суммы по месяцам и категориям
+    year = params['year']
+    set_progress(conn, job_id, 10)
+
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""
+        SELECT EXTRACT(MONTH FROM created_at)::int AS month, category,
+               SUM(amount) AS total, COUNT(*) AS count
+        FROM expenses
+        WHERE user_id = %s
+          AND created_at >= make_date(%s, 1, 1)
+          AND created_at < make_date(%s + 1, 1, 1)
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+    """, (user_id, year, year))
+    rows = cur.fetchall()
+    cur.close()
+    set_progress(conn, job_id, 80)
+
+    report = {
+        "year": year,
+        "total": str(sum(row['total'] for row in rows)),
+        "rows": [
+            {"month": row['month'], "category": row['category'],
+             "total": str(row['total']), "count": row['count']}
+            for row in rows
+        ],
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+JOB_HANDLERS = {
+    'export': (export_expenses, '.csv'),
+    'report': (yearly_report, '.json'),
+}
+
+
+def run_job(job_id):
+    # Выполняется в дочернем процессе пула, поэтому открывает своё соединение.
+    # Любая ошибка, включая отсутствующую задачу и неизвестный тип, завершает задачу
+    # как failed, а не оставляет её в статусе running
+    conn = get_db_connection()
+    tmp_path = None
+
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT user_id, kind, params FROM jobs WHERE id = %s", (job_id,))
+        job = cur.fetchone()
+        cur.close()
+        conn.commit()
+        if job is None:
+            raise LookupError(f"Job {job_id} not found")
+        if job['kind'] not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job kind {job['kind']!r}")
+
+        handler, ext = JOB_HANDLERS[job['kind']]
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        path = os.path.join(JOBS_DIR, f"job_{job_id}{ext}")
+        tmp_path = path + '.tmp'
+
+        handler(conn, job_id, job['user_id'], json.loads(job['params'] or '{}'), tmp_path)
+        conn.commit()
+        os.replace(tmp_path, path)
+        finish_job(conn, job_id, 'done', result_path=path)
+    except JobCancelled:
+        conn.rollback()
+        finish_job(conn, job_id, 'cancelled')
+    except Exception as e:
+        print(f"Error in job {job_id}: {e}")
+        conn.rollback()
+        finish_job(conn, job_id, 'failed', error=str(e))
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn.close()
+
+
+def finish_job(conn, job_id, status, result_path=None, error=None):
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE jobs
+        SET status = %s, result_path = %s, error = %s,
+            progress = CASE WHEN %s = 'done' THEN 100 ELSE progress END,
+            finished_at = CURRENT_TIMESTAMP,
+            expires_at = CASE WHEN %s = 'done'
+                THEN CURRENT_TIMESTAMP + make_interval(hours => %s) END
+        WHERE id = %s
+    """, (status, result_path, error, status, status, RESULT_TTL_HOURS, job_id))
+    conn.commit()
+    cur.close()
+
+
+def heartbeat(job_ids):
+    # Продлеваем аренду задач, которые выполняются в пуле этого воркера
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(%s) AND status = 'running'
+    """, (list(job_ids),))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def release_job(job_id, error):
+    # Процесс пула упал, не завершив задачу: возвращаем её в очередь,
+    # пока не исчерпаны попытки, иначе помечаем как failed
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE jobs
+        SET status = CASE WHEN cancel_requested THEN 'cancelled'
+                          WHEN attempts >= %s THEN 'failed' ELSE 'queued' END,
+            error = CASE WHEN attempts >= %s AND NOT cancel_requested THEN %s ELSE error END,
+            finished_at = CASE WHEN cancel_requested OR attempts >= %s THEN CURRENT_TIMESTAMP END,
+            progress = 0
+        WHERE id = %s AND status = 'running'
+    """, (JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, error, JOB_MAX_ATTEMPTS, job_id))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def recover_stale_jobs():
+    # Задачи воркера, который умер целиком, перестают получать heartbeat:
+    # по истечении аренды они возвращаются в очередь или завершаются как failed
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE jobs
+        SET status = CASE WHEN cancel_requested THEN 'cancelled'
+                          WHEN attempts >= %s THEN 'failed' ELSE 'queued' END,
+            error = CASE WHEN attempts >= %s AND NOT cancel_requested THEN 'Worker lost' ELSE error END,
+            finished_at = CASE WHEN cancel_requested OR attempts >= %s THEN CURRENT_TIMESTAMP END,
+            progress = 0
+        WHERE status = 'running'
+          AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+    """, (JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, JOB_LEASE_SECONDS))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def expire_results():
+    # Удаляем просроченные результаты с диска
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        WITH expired AS (
+            SELECT id, result_path FROM jobs
+            WHERE status = 'done' AND expires_at < CURRENT_TIMESTAMP
+            FOR UPDATE
+        )
+        UPDATE jobs SET status = 'expired', result_path = NULL
+        FROM expired
+        WHERE jobs.id = expired.id
+        RETURNING expired.result_path
+    """)
+    paths = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def compact_tombstones():
+    # Удаляем старые надгробия и сдвигаем горизонт: клиенты с токеном
+    # старше горизонта при следующей синхронизации получат полный список
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        WITH purged AS (
+            DELETE FROM expense_tombstones
+            WHERE deleted_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+            RETURNING change_seq
+        )
+        UPDATE sync_horizon
+        SET purged_seq = GREATEST(purged_seq, (SELECT MAX(change_seq) FROM purged))
+    """, (TOMBSTONE_TTL_DAYS,))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def main():
+    print(f"Воркер запущен: процессов {JOB_WORKERS}")
+    running = {}
+    last_expire = float('-inf')
+    executor = ProcessPoolExecutor(max_workers=JOB_WORKERS)
+    try:
+        while True:
+            if time.monotonic() - last_expire > EXPIRE_INTERVAL:
+                expire_results()
+                compact_tombstones()
+                remove_orphaned_attachments()
+                recover_stale_jobs()
+                last_expire = time.monotonic()
+
+            while len(running) < JOB_WORKERS:
+                job_id = claim_job()
+                if job_id is None:
+                    break
+                running[executor.submit(run_job, job_id)] = job_id
+
+            if running:
+                heartbeat(running.values())
+                done, _ = wait(running, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    job_id = running.pop(future)
+                    error = future.exception()
+                    if error:
+                        # run_job сам завершает задачу при ошибке, поэтому сюда попадает
+                        # только падение процесса пула
+                        print(f"Job process error: {error}")
+                        release_job(job_id, str(error))
+                        broken = broken or isinstance(error, BrokenProcessPool)
+                if broken:
+                    # После падения процесса пул непригоден: остальные задачи тоже
+                    # завершатся с BrokenProcessPool и вернутся в очередь
+                    for future, job_id in running.items():
+                        release_job(job_id, "Worker process died")
+                    running.clear()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = ProcessPoolExecutor(max_workers=JOB_WORKERS)
+            else:
+                time.sleep(POLL_INTERVAL)
+    finally:
+        executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()